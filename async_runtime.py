@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Asyncio runtime for the bot's optional async execution mode.
+
+An event loop runs on a background thread. Handlers submit coroutines to it
+and return straight away, so a slow upstream no longer ties up a dispatcher
+thread. Blocking work (upstream fetches, rendering, Telegram calls) is awaited
+through call(), which runs it on a thread pool and caps how many calls to each
+upstream may be in flight at once.
+"""
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRuntime:
+    def __init__(self, limits: dict, workers: int = 16) -> None:
+        """limits maps an upstream name to its maximum number of concurrent calls."""
+        self.limits = limits
+        self.semaphores = {}
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="async_runtime")
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="async_runtime", daemon=True
+        )
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.executor.shutdown(wait=False)
+
+    def submit(self, coroutine):
+        """Schedule coroutine on the loop and return a concurrent Future."""
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(self.logFailure)
+        return future
+
+    def run(self, coroutine, timeout: float = None):
+        """Run coroutine on the loop and block the calling thread for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def getSemaphore(self, upstream: str) -> asyncio.Semaphore:
+        # Only ever called from the loop thread, so no locking is needed
+        if upstream not in self.semaphores:
+            self.semaphores[upstream] = asyncio.Semaphore(self.limits.get(upstream, 4))
+        return self.semaphores[upstream]
+
+    async def call(self, upstream: str, function, *args, **kwargs):
+        """Await a blocking call, limited by the concurrency cap for upstream."""
+        async with self.getSemaphore(upstream):
+            return await self.loop.run_in_executor(
+                self.executor, functools.partial(function, *args, **kwargs)
+            )
+
+    @staticmethod
+    def logFailure(future) -> None:
+        if not future.cancelled() and future.exception() != None:
+            logger.error("Async task failed", exc_info=future.exception())
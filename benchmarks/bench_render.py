@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Renders each chart type from synthetic data with every render profile and
+reports the mean render time and the size of the encoded image. "fresh" is
+the time when every render builds its figure from scratch, i.e. without the
+figure templates kept per thread.
+
+Usage: python benchmarks/bench_render.py [days] [repeats]
+"""
+
+import datetime
+import os
+import sys
+import threading
+import time
+
+import matplotlib
+
+matplotlib.use("Agg")
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import chart_output
+import covid_stats_plotter
+import render_service
+import timeseries
+
+
+def makeHistory(days: int) -> dict:
+    history = {}
+    confirmed = 0
+    deaths = 0
+    start = datetime.datetime(2020, 1, 22)
+    for day in range(days):
+        newConfirmed = (day * 37) % 1000
+        newDeaths = (day * 7) % 20
+        confirmed += newConfirmed
+        deaths += newDeaths
+        date = start + datetime.timedelta(days=day)
+        history[str(date)] = {
+            "confirmed": confirmed,
+            "deaths": deaths,
+            "change_confirmed": str(newConfirmed),
+            "change_deaths": str(newDeaths),
+        }
+    return history
+
+
+def makeSpecs(days: int) -> list:
+    index = timeseries.HistoryIndex(makeHistory(days))
+    dates = pd.date_range("2020-12-16", periods=days, freq="D")
+    shots = np.linspace(0.0, 80.0, days)
+    daily = 1000.0 + 500.0 * np.sin(np.arange(days) / 20.0)
+    return [
+        covid_stats_plotter.getCasesChartSpec(index, "Benchmark Cases"),
+        {
+            "chart": "vaccinations",
+            "title": "Vaccinations for Benchmark",
+            "dates": dates,
+            "total_vaccinations": shots,
+            "total_vaccinated": shots * 0.8,
+            "new_vaccinations": daily,
+            "new_vaccinated": daily * 0.6,
+        },
+        {
+            "chart": "country_vaccinations",
+            "title": "Vaccinations for Benchmark",
+            "dates": [str(date.date()) for date in dates],
+            "columns": {
+                "1-shot %": list(shots),
+                "2-shot %": list(shots * 0.8),
+                "New Vaccinations": list(daily),
+            },
+        },
+    ]
+
+
+def timeRenders(spec: dict, repeats: int) -> tuple:
+    """Return the mean seconds per render and the last image."""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        image = render_service.renderChart(spec)
+    return (time.perf_counter() - start) / repeats, image
+
+
+def timeFreshRenders(spec: dict, repeats: int) -> float:
+    # A new thread has no templates yet
+    start = time.perf_counter()
+    for _ in range(repeats):
+        thread = threading.Thread(target=lambda: render_service.renderChart(spec))
+        thread.start()
+        thread.join()
+    return (time.perf_counter() - start) / repeats
+
+
+def main() -> None:
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 700
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    specs = makeSpecs(days)
+
+    row = "{:<22}{:<10}{:>12}{:>12}{:>12}"
+    print(row.format("chart", "profile", "ms/render", "ms/fresh", "KB"))
+    for spec in specs:
+        for profile in chart_output.renderProfiles:
+            chart_output.setRenderProfile(profile)
+            # The first render pays for font loading and caches
+            render_service.renderChart(spec)
+            elapsed, image = timeRenders(spec, repeats)
+            fresh = timeFreshRenders(spec, repeats)
+            print(
+                row.format(
+                    spec["chart"],
+                    profile,
+                    "{:.1f}".format(1000 * elapsed),
+                    "{:.1f}".format(1000 * fresh),
+                    "{:.1f}".format(len(image) / 1024),
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Compares parsing a covid19tracker.ca report the old way (json.loads of the
+whole body, then pulling the plotted fields out of the record dicts) with
+report_parser, which is fed the body in chunks as http_client would, and with
+parseLatestRecord. Prints the time and peak Python memory of each and checks
+they give the same columns.
+
+Usage: python benchmarks/bench_report_parser.py [report.json] [repeats]
+"""
+
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+import numpy as np
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(benchmarkDir, ".."))
+sys.path.insert(0, benchmarkDir)
+import record_fixtures
+import report_parser
+import timeseries
+
+chunkSize = 64 * 1024
+
+
+def parseWhole(body: bytes) -> dict:
+    """What vaccinations did before report_parser, treating None as 0."""
+    records = json.loads(body.decode())["data"]
+    columns = {}
+    for field in report_parser.reportFields:
+        values = np.array([record[field] for record in records], dtype=float)
+        columns[field] = np.nan_to_num(values, nan=0.0)
+    columns["date"] = timeseries.parseDates([record["date"] for record in records])
+    return columns
+
+
+def parseStreamed(body: bytes) -> dict:
+    parser = report_parser.ReportParser()
+    for start in range(0, len(body), chunkSize):
+        parser.write(body[start : start + chunkSize])
+    report = parser.result()
+    columns = {
+        field: np.nan_to_num(values, nan=0.0)
+        for field, values in report.columns.items()
+    }
+    columns["date"] = report.dates
+    return columns
+
+
+def measure(parse, body: bytes, repeats: int) -> tuple:
+    """Return (ms per parse, peak KB allocated while parsing)."""
+    seconds = min(timeit.repeat(lambda: parse(body), number=repeats, repeat=3))
+    tracemalloc.start()
+    parse(body)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return 1000 * seconds / repeats, peak / 1024
+
+
+def main() -> None:
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as report:
+            body = report.read()
+    else:
+        body = json.dumps(record_fixtures.syntheticReport(1, "ON")).encode()
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    whole = parseWhole(body)
+    streamed = parseStreamed(body)
+    for field in report_parser.reportFields:
+        assert np.array_equal(whole[field], streamed[field]), field
+    assert (whole["date"].values.astype("datetime64[D]") == streamed["date"]).all()
+    latest = json.loads(body)["data"][-1]
+    assert report_parser.parseLatestRecord(body) == latest
+
+    print(
+        "{:.0f} KB report, {} records".format(len(body) / 1024, len(streamed["date"]))
+    )
+    row = "{:<22}{:>10}{:>12}"
+    print(row.format("parser", "ms", "peak KB"))
+    for name, parse in [
+        ("json.loads", parseWhole),
+        ("report_parser", parseStreamed),
+        ("parseLatestRecord", report_parser.parseLatestRecord),
+    ]:
+        milliseconds, peak = measure(parse, body, repeats)
+        print(row.format(name, "{:.2f}".format(milliseconds), "{:.0f}".format(peak)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Measures how long `import covid_bot` takes in a fresh interpreter, prints the
+slowest imports from -X importtime, and checks that none of the heavy data
+modules are loaded at start-up. Exits with status 1 if the median import time
+is over the threshold or a heavy module was imported, so it can guard against
+start-up regressions.
+
+Usage: python benchmarks/bench_startup.py [runs] [threshold seconds]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+repoDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+# covid_bot must not import any of these until a command needs them
+heavyModules = ["pandas", "numpy", "matplotlib", "prettytable", "countryinfo", "covid"]
+importScript = """
+import sys, time
+start = time.perf_counter()
+import covid_bot
+print(time.perf_counter() - start)
+print(",".join(name for name in sys.argv[1:] if name in sys.modules))
+"""
+
+
+def runImport(environment: dict, importTime: bool = False) -> tuple:
+    """Return (seconds, heavy modules loaded, importtime report) for one run."""
+    command = [sys.executable]
+    if importTime:
+        command += ["-X", "importtime"]
+    command += ["-c", importScript] + heavyModules
+    result = subprocess.run(
+        command, env=environment, capture_output=True, text=True, check=True
+    )
+    seconds, loaded = result.stdout.split("\n")[:2]
+    return float(seconds), [name for name in loaded.split(",") if name], result.stderr
+
+
+def parseImportTime(report: str) -> list:
+    """Return (cumulative microseconds, module) for each line of the report."""
+    imports = []
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:") :].split("|")
+        imports.append((int(cumulative), module.rstrip()))
+    return imports
+
+
+def main() -> None:
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    threshold = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+
+    with tempfile.TemporaryDirectory() as tokenDir:
+        # covid_bot reads the bot token at import; the real one isn't needed
+        with open(os.path.join(tokenDir, "telegram_token_key.py"), "w") as tokenFile:
+            tokenFile.write('m_token = "0:benchmark"\n')
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.pathsep.join(
+            [repoDir, tokenDir, environment.get("PYTHONPATH", "")]
+        )
+
+        _, loaded, report = runImport(environment, importTime=True)
+        times = [runImport(environment)[0] for _ in range(runs)]
+
+    print("Slowest imports (cumulative ms):")
+    for cumulative, module in sorted(parseImportTime(report), reverse=True)[:15]:
+        print("{:>10.1f}  {}".format(cumulative / 1000, module))
+    median = statistics.median(times)
+    print(
+        "import covid_bot: median {:.3f}s, min {:.3f}s over {} runs".format(
+            median, min(times), runs
+        )
+    )
+
+    failed = False
+    if len(loaded) > 0:
+        print("FAIL: heavy modules imported at start-up: " + ", ".join(loaded))
+        failed = True
+    if median > threshold:
+        print("FAIL: median is over the {:.3f}s threshold".format(threshold))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
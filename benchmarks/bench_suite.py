@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark of the bot that runs offline against the fixtures from
+record_fixtures.py (synthetic ones are written first if there are none).
+
+covid19tracker.ca is replaced by a local HTTP server that serves the recorded
+reports, CovId19Data by a client that returns the recorded histories, and the
+OWID CSV by the recorded sample, each with an optional simulated latency. It
+measures:
+
+    dataset_build        building the OWID per-location cache from the CSV
+    dataset_read         reading every benchmark country from that cache
+    render_<chart>       rendering each chart from a prepared spec
+    graphs_cold/_warm    getGraphImages for every location, empty/full caches
+    summary_cold/_warm   getSummary the same way
+    concurrent_report    wall time per report with many chats asking at once
+    peak_rss_mb          the process's peak resident memory
+
+Times are the median over the repeats, in seconds. Results are compared with
+the baseline file and the run exits with status 1 if any is more than the
+threshold above its baseline; --save-baseline writes the results as the new
+baseline instead. Baselines depend on the machine, so keep one per machine.
+
+Usage: python benchmarks/bench_suite.py [--fixtures DIR] [--baseline FILE]
+           [--save-baseline] [--threshold 0.25] [--repeats 3] [--chats 16]
+           [--latency SECONDS] [--workers N]
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import http.server
+import json
+import logging
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+repoDir = os.path.join(benchmarkDir, "..")
+sys.path.insert(0, repoDir)
+sys.path.insert(0, benchmarkDir)
+import record_fixtures
+import render_service
+
+defaultBaselineFile = os.path.join(benchmarkDir, "baseline.json")
+# (country, state) as a user would type them
+benchmarkLocations = [
+    ("canada", "ontario"),
+    ("canada", "quebec"),
+    ("india", None),
+    ("united states", None),
+    ("germany", "british columbia"),
+]
+reportsPerChat = 4
+
+
+class FixtureServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, reportDir: str, latency: float) -> None:
+        super().__init__(("127.0.0.1", 0), FixtureHandler)
+        self.reportDir = reportDir
+        self.latency = latency
+        self.requests = 0
+
+    def getURL(self, path: str) -> str:
+        return "http://127.0.0.1:{}{}".format(self.server_port, path)
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        self.server.requests += 1
+        time.sleep(self.server.latency)
+        if self.path == "/reports":
+            name = "canada"
+        elif self.path.startswith("/reports/province/"):
+            name = self.path[len("/reports/province/") :]
+        else:
+            name = ""
+        path = os.path.join(self.server.reportDir, name + ".json")
+        if name == "" or not os.path.exists(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as report:
+            body = report.read()
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class FixtureClient:
+    """Stands in for CovId19Data with the recorded lists and histories."""
+
+    def __init__(self, data: dict, latency: float) -> None:
+        self.data = data
+        self.latency = latency
+        time.sleep(latency)
+
+    def show_available_countries(self) -> list:
+        return self.data["countries"]
+
+    def show_available_regions(self) -> list:
+        return self.data["regions"]
+
+    def get_history_by_country(self, country: str) -> dict:
+        time.sleep(self.latency)
+        return self.data["history"]["country"][country]
+
+    def get_history_by_province(self, province: str) -> dict:
+        time.sleep(self.latency)
+        return self.data["history"]["province"][province]
+
+
+class FakePhoto:
+    def __init__(self, fileId: str) -> None:
+        self.file_id = fileId
+
+
+class FakeMessage:
+    """Enough of a telegram Message for replyWithReport."""
+
+    def __init__(self, chatId: int) -> None:
+        self.chat_id = chatId
+        self.photo = [FakePhoto("photo-" + str(chatId))]
+
+    def reply_media_group(self, media: list, **kwargs) -> list:
+        return [FakeMessage(self.chat_id) for _ in media]
+
+    def reply_text(self, text: str, **kwargs) -> "FakeMessage":
+        return self
+
+
+class FakeUpdate:
+    def __init__(self, chatId: int) -> None:
+        self.message = FakeMessage(chatId)
+
+
+def parseArguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark")
+    parser.add_argument("--fixtures", default=record_fixtures.defaultFixtureDir)
+    parser.add_argument("--baseline", default=defaultBaselineFile)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--chats", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=0)
+    return parser.parse_args()
+
+
+def medianTime(run, repeats: int, setup=None) -> float:
+    """Median seconds of run() over repeats calls, calling setup() untimed first."""
+    times = []
+    for _ in range(repeats):
+        if setup != None:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+class Suite:
+    def __init__(self, args: argparse.Namespace, workDir: str) -> None:
+        self.args = args
+        self.workDir = workDir
+        with open(os.path.join(args.fixtures, "covid19data.json")) as historyFile:
+            self.histories = json.load(historyFile)
+        self.server = FixtureServer(
+            os.path.join(args.fixtures, "covid19tracker"), args.latency
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        shutil.copy(os.path.join(args.fixtures, "owid-covid-data.csv"), workDir)
+
+        # covid_bot reads the bot token at import; the real one isn't needed
+        with open(os.path.join(workDir, "telegram_token_key.py"), "w") as tokenFile:
+            tokenFile.write('m_token = "0:benchmark"\n')
+        sys.path.insert(0, workDir)
+        import covid_bot
+
+        self.bot = covid_bot
+        # Its per-request cache logging would bury the results
+        logging.getLogger("covid_bot").setLevel(logging.WARNING)
+        # covid_bot's LazyModules would take the attributes set below themselves
+        self.plotter = covid_bot.covid_stats_plotter.load()
+        self.vaccinations = covid_bot.vaccinations.load()
+        self.owid = covid_bot.global_vaccinations.load()
+        self.vaccinations.urlCanada = self.server.getURL("/reports")
+        self.vaccinations.urlProvince = self.server.getURL("/reports/province/")
+        if args.workers > 0:
+            covid_bot.renderService = covid_bot.RenderService(workers=args.workers)
+
+    def newHistoryStore(self):
+        return self.plotter.HistoryStore(
+            clientFactory=lambda: FixtureClient(self.histories, self.args.latency)
+        )
+
+    def resetCaches(self) -> None:
+        """Forget every fetched dataset and rendered chart, as after a restart."""
+        bot = self.bot
+        bot.chartCache = bot.ChartCache(maxBytes=bot.chartCache.maxBytes)
+        bot.summaryCache = bot.ChartCache(maxBytes=bot.summaryCache.maxBytes)
+        bot.fileIdCache = bot.FileIdCache()
+        self.vaccinations.reportCache.invalidate()
+        self.vaccinations.latestRecordCache.invalidate()
+        self.plotter.setHistoryStore(self.newHistoryStore())
+
+    def removeDatasetCache(self) -> None:
+        shutil.rmtree(self.owid.datasetCacheDir, ignore_errors=True)
+        self.owid.loadedManifest = None
+
+    def benchDataset(self, results: dict) -> None:
+        owid = self.owid
+        results["dataset_build"] = medianTime(
+            owid.loadDatasetCache, self.args.repeats, self.removeDatasetCache
+        )
+        countries = [
+            name
+            for name in record_fixtures.owidCountries
+            if name in owid.getLocations()
+        ]
+        results["dataset_read"] = medianTime(
+            lambda: [owid.getCountryData(name) for name in countries], self.args.repeats
+        )
+
+    def benchRenders(self, results: dict) -> None:
+        self.resetCaches()
+        specs = {}
+        for country, state in benchmarkLocations:
+            for chartType, _, _, getSpec in self.bot.getChartList(country, state):
+                if chartType not in specs:
+                    specs[chartType] = getSpec()
+        for chartType, spec in sorted(specs.items()):
+            # The first render pays for font loading and building the template
+            render_service.renderChart(spec)
+            results["render_" + chartType] = medianTime(
+                lambda: render_service.renderChart(spec), self.args.repeats
+            )
+
+    def runReports(self, getPart) -> None:
+        for country, state in benchmarkLocations:
+            getPart(country, state)
+
+    def benchReports(self, results: dict) -> None:
+        repeats = self.args.repeats
+        for name, getPart in [
+            ("graphs", self.bot.getGraphImages),
+            ("summary", self.bot.getSummary),
+        ]:
+            run = lambda: self.runReports(getPart)
+            results[name + "_cold"] = medianTime(run, repeats, self.resetCaches)
+            results[name + "_warm"] = medianTime(run, repeats)
+
+    def benchConcurrentChats(self, results: dict) -> None:
+        chats = self.args.chats
+
+        def runChat(chat: int) -> None:
+            # Each chat asks for a different mix of locations
+            for report in range(reportsPerChat):
+                location = benchmarkLocations[(chat + report) % len(benchmarkLocations)]
+                self.bot.replyWithReport(FakeUpdate(chat), *location)
+
+        def run() -> None:
+            with concurrent.futures.ThreadPoolExecutor(chats) as executor:
+                list(executor.map(runChat, range(chats)))
+
+        elapsed = medianTime(run, self.args.repeats, self.resetCaches)
+        reports = chats * reportsPerChat
+        results["concurrent_report"] = elapsed / reports
+        print(
+            "{} chats x {} reports: {:.1f} reports/s".format(
+                chats, reportsPerChat, reports / elapsed
+            )
+        )
+
+    def run(self) -> dict:
+        results = {}
+        self.benchDataset(results)
+        self.benchRenders(results)
+        self.benchReports(results)
+        self.benchConcurrentChats(results)
+        results["peak_rss_mb"] = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        )
+        self.server.shutdown()
+        self.bot.renderService.close()
+        return results
+
+
+def compareWithBaseline(results: dict, baseline: dict, threshold: float) -> list:
+    """Print the results against the baseline and return the regressed names."""
+    regressions = []
+    row = "{:<22}{:>14}{:>14}{:>10}"
+    print(row.format("benchmark", "result", "baseline", "change"))
+    for name, value in results.items():
+        previous = baseline.get(name)
+        if previous == None or previous == 0:
+            print(row.format(name, "{:.4f}".format(value), "-", "-"))
+            continue
+        change = value / previous - 1.0
+        print(
+            row.format(
+                name,
+                "{:.4f}".format(value),
+                "{:.4f}".format(previous),
+                "{:+.0%}".format(change),
+            )
+        )
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main() -> None:
+    args = parseArguments()
+    if not os.path.exists(os.path.join(args.fixtures, "covid19data.json")):
+        print("No fixtures in " + args.fixtures + ", writing synthetic ones")
+        record_fixtures.writeSyntheticFixtures(args.fixtures)
+
+    startDir = os.getcwd()
+    with tempfile.TemporaryDirectory() as workDir:
+        # The bot keeps its caches and databases in the working directory
+        os.chdir(workDir)
+        try:
+            results = Suite(args, workDir).run()
+        finally:
+            os.chdir(startDir)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+    regressions = compareWithBaseline(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baselineFile:
+            json.dump(results, baselineFile, indent=2)
+        print("Saved the baseline to " + args.baseline)
+    elif len(regressions) > 0:
+        print(
+            "FAIL: over the {:.0%} threshold: {}".format(
+                args.threshold, ", ".join(regressions)
+            )
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Compares the old per-day ring-buffer averages with the vectorized timeseries
+helpers on synthetic multi-year histories, and checks they give the same result.
+
+Usage: python benchmarks/bench_timeseries.py [days] [repeats]
+"""
+
+import datetime
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import timeseries
+
+
+def makeHistory(days: int) -> dict:
+    history = {}
+    confirmed = 0
+    deaths = 0
+    start = datetime.datetime(2020, 1, 22)
+    for day in range(days):
+        confirmed += (day * 37) % 1000
+        deaths += (day * 7) % 20
+        date = start + datetime.timedelta(days=day)
+        history[str(date)] = {"confirmed": confirmed, "deaths": deaths}
+    return history
+
+
+def loopAverages(history: dict) -> tuple:
+    """The per-day loop plotData used before the timeseries module."""
+    y_data = []
+    y2_data = []
+    index = 0
+    windowSize = 7
+    movingWindow = windowSize * [0]
+    movingWindow2 = windowSize * [0]
+    last = 0
+    last2 = 0
+    for day, data in history.items():
+        confirmed = data["confirmed"]
+        deaths = data["deaths"]
+        movingWindow[index] = confirmed - last
+        movingWindow2[index] = deaths - last2
+        last = confirmed
+        last2 = deaths
+        y_data.append(sum(movingWindow) / len(movingWindow))
+        y2_data.append(sum(movingWindow2) / len(movingWindow2))
+        index = 0 if (index == (windowSize - 1)) else (index + 1)
+    return y_data, y2_data
+
+
+def vectorizedAverages(history: dict) -> tuple:
+    _, columns = timeseries.historyToArrays(history, ["confirmed", "deaths"])
+    return (
+        timeseries.rollingMean(timeseries.dailyChange(columns["confirmed"])),
+        timeseries.rollingMean(timeseries.dailyChange(columns["deaths"])),
+    )
+
+
+def main() -> None:
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 3 * 365
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    history = makeHistory(days)
+
+    expected = loopAverages(history)
+    actual = vectorizedAverages(history)
+    for expectedSeries, actualSeries in zip(expected, actual):
+        if not np.allclose(expectedSeries, actualSeries):
+            raise SystemExit("Vectorized averages differ from the loop averages")
+
+    loopTime = timeit.timeit(lambda: loopAverages(history), number=repeats) / repeats
+    vectorTime = (
+        timeit.timeit(lambda: vectorizedAverages(history), number=repeats) / repeats
+    )
+    print("History length: " + str(days) + " days")
+    print("Loop:       {:.3f} ms".format(loopTime * 1000))
+    print("Vectorized: {:.3f} ms".format(vectorTime * 1000))
+    print("Speedup:    {:.1f}x".format(loopTime / vectorTime))
+
+
+if __name__ == "__main__":
+    main()
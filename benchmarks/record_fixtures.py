@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Records the upstream data bench_suite.py runs against into a fixture
+directory:
+
+    covid19tracker/<name>.json  the covid19tracker.ca report for Canada
+                                ("canada") and each province code
+    covid19data.json            the CovId19Data country and region lists and
+                                the histories of the benchmark locations
+    owid-covid-data.csv         the OWID CSV cut down to the benchmark countries
+
+With --synthetic it writes generated data of the same shape instead, so the
+suite can run without network access. Synthetic data is the same on every run.
+
+Usage: python benchmarks/record_fixtures.py [--synthetic] [fixture dir]
+"""
+
+import csv
+import datetime
+import io
+import json
+import os
+import sys
+import urllib.request
+
+defaultFixtureDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+covid19trackerURL = "https://api.covid19tracker.ca/reports"
+provinceCodes = "AB BC MB NB NL NS NT NU ON PE QC SK YT".split()
+# Locations whose histories are recorded, by their CovId19Data names
+casesCountries = ["Canada", "India", "US", "Germany"]
+casesRegions = ["Ontario", "Quebec", "British Columbia", "Alberta"]
+owidDataURL = "https://covid.ourworldindata.org/data/owid-covid-data.csv"
+owidCountries = {
+    "Canada": "CAN",
+    "India": "IND",
+    "United States": "USA",
+    "Germany": "DEU",
+    "Cote d'Ivoire": "CIV",
+}
+owidColumns = [
+    "iso_code",
+    "continent",
+    "location",
+    "date",
+    "total_cases",
+    "new_cases",
+    "total_deaths",
+    "new_deaths",
+    "total_vaccinations",
+    "people_vaccinated",
+    "people_fully_vaccinated",
+    "total_boosters",
+    "new_vaccinations",
+    "new_vaccinations_smoothed",
+    "total_vaccinations_per_hundred",
+    "people_vaccinated_per_hundred",
+    "people_fully_vaccinated_per_hundred",
+    "population",
+]
+# covid19tracker.ca report fields; the synthetic reports carry all of them
+reportFields = [
+    "cases",
+    "fatalities",
+    "tests",
+    "hospitalizations",
+    "criticals",
+    "recoveries",
+    "vaccinations",
+    "vaccinated",
+    "boosters_1",
+    "boosters_2",
+    "vaccines_distributed",
+]
+syntheticStart = datetime.date(2020, 1, 22)
+syntheticDays = 1100
+
+
+def download(url: str) -> bytes:
+    request = urllib.request.Request(url, headers={"User-Agent": "covid-bot-bench"})
+    with urllib.request.urlopen(request, timeout=120) as response:
+        return response.read()
+
+
+def writeFile(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as output:
+        output.write(data)
+    print("Wrote {} ({:.1f} KB)".format(path, len(data) / 1024))
+
+
+def recordReports(fixtureDir: str) -> None:
+    urls = {"canada": covid19trackerURL}
+    for code in provinceCodes:
+        urls[code] = covid19trackerURL + "/province/" + code
+    for name, url in urls.items():
+        writeFile(
+            os.path.join(fixtureDir, "covid19tracker", name + ".json"), download(url)
+        )
+
+
+def recordHistories(fixtureDir: str) -> None:
+    from covid.api import CovId19Data
+
+    client = CovId19Data(force=True)
+    data = {
+        "countries": client.show_available_countries(),
+        "regions": client.show_available_regions(),
+        "history": {
+            "country": {
+                name: client.get_history_by_country(name) for name in casesCountries
+            },
+            "province": {
+                name: client.get_history_by_province(name) for name in casesRegions
+            },
+        },
+    }
+    writeFile(
+        os.path.join(fixtureDir, "covid19data.json"),
+        json.dumps(data, default=str).encode(),
+    )
+
+
+def recordDataset(fixtureDir: str) -> None:
+    reader = csv.reader(io.StringIO(download(owidDataURL).decode()))
+    header = next(reader)
+    locationColumn = header.index("location")
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(header)
+    for row in reader:
+        if row[locationColumn] in owidCountries:
+            writer.writerow(row)
+    writeFile(
+        os.path.join(fixtureDir, "owid-covid-data.csv"), output.getvalue().encode()
+    )
+
+
+def syntheticWave(day: int, scale: float, seed: int) -> float:
+    # Repeating waves that differ per location; no randomness, so no drift
+    return scale * (1.0 + ((day * (seed + 7)) % 97) / 97.0) * (1 + (day // 120) % 3)
+
+
+def syntheticReport(seed: int, province: str = None) -> dict:
+    totals = dict.fromkeys(reportFields, 0)
+    data = []
+    for day in range(syntheticDays):
+        date = syntheticStart + datetime.timedelta(days=day)
+        record = {"date": date.isoformat()}
+        # Doses are counted last, from the second doses and boosters
+        fields = sorted(reportFields, key=lambda field: field == "vaccinations")
+        for field in fields:
+            number = reportFields.index(field)
+            change = int(syntheticWave(day, 100 + 10 * number, seed + number))
+            if field.startswith("boosters") and day < 600 + 60 * (
+                field == "boosters_2"
+            ):
+                record["change_" + field] = None
+                record["total_" + field] = None
+                continue
+            if field == "vaccinations":
+                # Every dose counts: first doses plus the second doses and boosters
+                change += record["change_vaccinated"] + sum(
+                    record.get("change_" + booster) or 0
+                    for booster in ("boosters_1", "boosters_2")
+                )
+            totals[field] += change
+            record["change_" + field] = change
+            record["total_" + field] = totals[field]
+        data.append(record)
+    report = {"last_updated": str(syntheticStart + datetime.timedelta(syntheticDays))}
+    if province != None:
+        report["province"] = province
+    report["data"] = data
+    return report
+
+
+def syntheticHistory(label: str, seed: int) -> dict:
+    history = {}
+    confirmed = 0
+    deaths = 0
+    for day in range(syntheticDays):
+        date = datetime.datetime.combine(
+            syntheticStart + datetime.timedelta(days=day), datetime.time()
+        )
+        newConfirmed = int(syntheticWave(day, 1000, seed))
+        newDeaths = newConfirmed // 60
+        confirmed += newConfirmed
+        deaths += newDeaths
+        history[str(date)] = {
+            "confirmed": confirmed,
+            "change_confirmed": str(newConfirmed),
+            "deaths": deaths,
+            "change_deaths": str(newDeaths),
+        }
+    labelId = label.lower().replace(" ", "_")
+    return {labelId: {"label": label, "lat": "0", "long": "0", "history": history}}
+
+
+def syntheticDataset() -> str:
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(owidColumns)
+    for seed, (location, isoCode) in enumerate(owidCountries.items()):
+        people = 0.0
+        fully = 0.0
+        for day in range(syntheticDays):
+            date = syntheticStart + datetime.timedelta(days=day)
+            values = dict.fromkeys(owidColumns, "")
+            values.update(iso_code=isoCode, location=location, date=date.isoformat())
+            values["population"] = 10000000 * (seed + 1)
+            if day >= 330:
+                daily = syntheticWave(day, 20000, seed)
+                people += daily * 0.6
+                fully += daily * 0.3
+                values["new_vaccinations"] = int(daily)
+                values["new_vaccinations_smoothed"] = int(daily * 0.95)
+                values["people_vaccinated"] = int(people)
+                values["people_fully_vaccinated"] = int(fully)
+                hundreds = values["population"] / 100.0
+                values["people_vaccinated_per_hundred"] = round(people / hundreds, 2)
+                values["people_fully_vaccinated_per_hundred"] = round(
+                    fully / hundreds, 2
+                )
+            writer.writerow([values[column] for column in owidColumns])
+    return output.getvalue()
+
+
+def writeSyntheticFixtures(fixtureDir: str) -> None:
+    writeFile(
+        os.path.join(fixtureDir, "covid19tracker", "canada.json"),
+        json.dumps(syntheticReport(0)).encode(),
+    )
+    for seed, code in enumerate(provinceCodes, 1):
+        writeFile(
+            os.path.join(fixtureDir, "covid19tracker", code + ".json"),
+            json.dumps(syntheticReport(seed, code)).encode(),
+        )
+    regions = casesRegions + ["Manitoba", "Nova Scotia", "Hubei", "New York"]
+    data = {
+        "countries": casesCountries + ["France", "Japan", "Brazil"],
+        "regions": regions,
+        "history": {
+            "country": {
+                name: syntheticHistory(name, seed)
+                for seed, name in enumerate(casesCountries)
+            },
+            "province": {
+                name: syntheticHistory(name, seed)
+                for seed, name in enumerate(casesRegions, 10)
+            },
+        },
+    }
+    writeFile(os.path.join(fixtureDir, "covid19data.json"), json.dumps(data).encode())
+    writeFile(
+        os.path.join(fixtureDir, "owid-covid-data.csv"), syntheticDataset().encode()
+    )
+
+
+def main() -> None:
+    args = [arg for arg in sys.argv[1:] if arg != "--synthetic"]
+    fixtureDir = args[0] if len(args) > 0 else defaultFixtureDir
+    if "--synthetic" in sys.argv[1:]:
+        writeSyntheticFixtures(fixtureDir)
+        return
+    recordReports(fixtureDir)
+    recordHistories(fixtureDir)
+    recordDataset(fixtureDir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Byte-bounded LRU cache for rendered chart images.
+
+Keys are (chart type, normalized location, data version) tuples, so a chart is
+only rendered again once the data it was drawn from has changed.
+"""
+import collections
+import threading
+
+
+def chartKey(chartType: str, location: str, version) -> tuple:
+    return (chartType, " ".join(location.lower().split()), version)
+
+
+class ChartCache:
+    def __init__(self, maxBytes: int = 64 * 1024 * 1024) -> None:
+        self.maxBytes = maxBytes
+        self.totalBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple) -> bytes:
+        with self.lock:
+            image = self.entries.get(key)
+            if image == None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key: tuple, image: bytes) -> None:
+        if len(image) > self.maxBytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.totalBytes -= len(self.entries.pop(key))
+            self.entries[key] = image
+            self.totalBytes += len(image)
+            while self.totalBytes > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.totalBytes -= len(evicted)
+
+    def hitRate(self) -> float:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return 0.0 if lookups == 0 else self.hits / lookups
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": self.totalBytes,
+            }
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Helpers for rendering matplotlib figures to image bytes in memory.
+
+Figures are built with matplotlib.figure.Figure rather than pyplot, so no
+global pyplot state is shared and charts can be rendered concurrently.
+
+How figures are encoded is set by the render profile. "quality" is the
+original 300 dpi PNG cropped to a tight bounding box. The lighter profiles
+render at about the resolution Telegram shows and use fixed margins instead
+of the extra layout pass a tight bounding box needs; "fast" then writes an
+indexed-colour PNG and "jpeg" a JPEG.
+
+Building a figure (axes, twin axes, formatters, legend) costs about as much
+as drawing it, so plotters keep a FigureTemplate per chart type in each
+thread and only swap the line data on later renders.
+"""
+import io
+import threading
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from PIL import Image
+
+renderProfiles = {
+    "quality": {"dpi": 300, "format": "png", "tight": True},
+    "fast": {"dpi": 120, "format": "png", "tight": False, "colors": 64},
+    "jpeg": {"dpi": 120, "format": "jpeg", "tight": False, "quality": 85},
+}
+# Room for the title, the rotated dates and a second y axis on the right
+fixedMargins = {"left": 0.12, "right": 0.86, "top": 0.9, "bottom": 0.2}
+renderProfile = "quality"
+# Each thread (and so each render worker) gets its own templates
+figureTemplates = threading.local()
+
+
+def setRenderProfile(name: str) -> None:
+    global renderProfile
+    if name not in renderProfiles:
+        raise ValueError(
+            "Unknown render profile "
+            + name
+            + ", use one of "
+            + ", ".join(renderProfiles)
+        )
+    renderProfile = name
+
+
+def newFigure(**kwargs) -> Figure:
+    return Figure(**kwargs)
+
+
+class FigureTemplate:
+    """A built figure whose named lines are given new data for each chart."""
+
+    def __init__(self, fig: Figure, axes: list, lines: dict) -> None:
+        self.fig = fig
+        self.axes = axes
+        self.lines = lines
+
+    def update(self, title: str, x, series: dict) -> Figure:
+        """Plot series[name] against x on each named line and rescale."""
+        self.axes[0].set_title(title)
+        for name, values in series.items():
+            self.lines[name].set_data(x, values)
+        # Twin axes share x, so every axis needs fresh limits before rescaling
+        for ax in self.axes:
+            ax.relim()
+        for ax in self.axes:
+            ax.autoscale_view()
+        return self.fig
+
+
+def getFigureTemplate(chartType: str, build) -> FigureTemplate:
+    """
+    Return this thread's template for chartType, calling build() to make it
+    the first time. Templates are kept per render profile, as encoding with
+    fixed margins changes the figure.
+    """
+    templates = getattr(figureTemplates, "templates", None)
+    if templates == None:
+        templates = figureTemplates.templates = {}
+    key = (chartType, renderProfile)
+    if key not in templates:
+        templates[key] = build()
+    return templates[key]
+
+
+def tightLayout(fig: Figure) -> None:
+    """fig.tight_layout(), skipped for profiles that use fixed margins."""
+    if renderProfiles[renderProfile]["tight"]:
+        fig.tight_layout()
+
+
+def figureToPng(fig: Figure) -> bytes:
+    """Encode fig with the current render profile (not always as a PNG)."""
+    profile = renderProfiles[renderProfile]
+    buffer = io.BytesIO()
+    if profile["tight"]:
+        fig.savefig(
+            buffer, format=profile["format"], dpi=profile["dpi"], bbox_inches="tight"
+        )
+        return buffer.getvalue()
+
+    fig.subplots_adjust(**fixedMargins)
+    if profile["format"] == "jpeg":
+        fig.savefig(
+            buffer,
+            format="jpeg",
+            dpi=profile["dpi"],
+            pil_kwargs={"quality": profile["quality"]},
+        )
+        return buffer.getvalue()
+
+    # Draw once and let Pillow write a palette PNG, a fraction of the RGBA size
+    canvas = FigureCanvasAgg(fig)
+    fig.set_dpi(profile["dpi"])
+    canvas.draw()
+    image = Image.frombuffer(
+        "RGBA", canvas.get_width_height(), canvas.buffer_rgba(), "raw", "RGBA", 0, 1
+    )
+    image = image.convert("RGB").quantize(
+        profile["colors"], method=Image.Quantize.FASTOCTREE
+    )
+    image.save(buffer, format="png")
+    return buffer.getvalue()
@@ -4,20 +4,42 @@ from telegram.ext import (
     Updater,
     CommandHandler,
     MessageHandler,
+    CallbackQueryHandler,
     Filters,
     CallbackContext,
 )
 from telegram import InputMediaPhoto, ParseMode, ChatAction
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
 import time
 import logging
+import threading
+import asyncio
+import sys
 from telegram_token_key import m_token
-from covid.lib.errors import CountryNotFound
-import covid_stats_plotter
-import vaccinations
-import global_vaccinations
-import os
+from lazy_module import LazyModule
+from chart_cache import ChartCache, chartKey
+from render_service import RenderService
+from report_fanout import Report, ReportFanout
+from subscription_store import Subscription, SubscriptionStore
+from file_id_cache import FileIdCache
+from async_runtime import AsyncRuntime
+from prefetcher import Prefetcher
+from location_index import LocationIndex, LocationNotFound, normalizeName
+from paginated_list import PaginatedList, paginate
+import metrics
 import datetime
 
+# The data and plotting modules pull in pandas, matplotlib and the COVID data
+# clients, so they are imported on first use (or by warmUp() after start-up)
+covid_stats_plotter = LazyModule("covid_stats_plotter")
+vaccinations = LazyModule("vaccinations")
+global_vaccinations = LazyModule("global_vaccinations")
+chart_output = LazyModule("chart_output")
+warmUpOnStart = True
+# Chats allowed to use /stats; --metrics-port=N also serves /metrics over HTTP
+statsChatIds = []
+
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -25,6 +47,53 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+chartCache = ChartCache()
+summaryCache = ChartCache(maxBytes=4 * 1024 * 1024)
+# Replaced with a process pool in main(); renders inline until then
+renderService = RenderService()
+renderWorkers = 4
+# "quality", "fast" or "jpeg" (see chart_output); --render-profile=NAME overrides
+renderProfile = "quality"
+# Opened in main(); due subscriptions are checked every subscriptionTickSeconds
+subscriptionDbFile = "subscriptions.db"
+subscriptionStore = None
+subscriptionTickSeconds = 20
+# Memory-only until main() opens the persistent cache
+fileIdCache = FileIdCache()
+fileIdDbFile = "file_ids.db"
+fileIdMaxAge = 30 * 24 * 3600
+# Most requested locations are re-rendered in the background; the publish
+# times (HH:MM UTC) are when the upstream sources usually post new data
+prefetchTopN = 10
+prefetchInterval = 10 * 60
+prefetchPublishTimes = ["00:30", "12:30"]
+# Started by main() when run with --async
+asyncRuntime = None
+upstreamLimits = {
+    "covid19data": 1,
+    "covid19tracker": 8,
+    "owid": 2,
+    "render": renderWorkers,
+    "summary": 4,
+    "telegram": 8,
+}
+# Built by main() at startup, or on first use
+locationIndex = None
+locationIndexLock = threading.Lock()
+# When the OWID locations couldn't be loaded, the index is built without them
+# and they are added in the background once this time (monotonic) has passed
+owidLocationsRetryAt = None
+owidLocationsRetryInterval = 15 * 60
+# Loaded on the first /country_list or /region_list and served from memory
+paginatedLists = {
+    "country": PaginatedList(
+        lambda: covid_stats_plotter.historyStore.getAvailableCountries()
+    ),
+    "region": PaginatedList(
+        lambda: covid_stats_plotter.historyStore.getAvailableRegions()
+    ),
+}
+
 # Define a few command handlers. These usually take the two arguments update and
 # context. Error handlers also receive the raised TelegramError object in error.
 def help(update: Update, _: CallbackContext) -> None:
@@ -37,9 +106,10 @@ def help(update: Update, _: CallbackContext) -> None:
         "/delete [N] - Delete Nth job\n"
         "/delete all - Delete all jobs\n"
         "/country [country] -  to print stats for a given country\n"
-        "/country_list -  List all of the countries\n"
+        "/country_list [prefix] -  List all of the countries\n"
         "/region [region] -  print stats for a given region\n"
-        "/region_list -  print a list of regions\n"
+        "/region_list [prefix] -  print a list of regions\n"
+        "/canada_all -  compare the vaccinations of every province\n"
         "/help -  to print this menu\n"
         "/info -  to print the README"
     )
@@ -52,97 +122,468 @@ def info(update: Update, _: CallbackContext) -> None:
     readme.close()
 
 
-def getGraphs(country="canada", state="ontario"):
-    images = []
-    if country != None:
-        images.append(covid_stats_plotter.outputCountryImage)
-        covid_stats_plotter.plotCountryCases(country)
-        if country.lower() == "canada":
-            images.append(vaccinations.canadaVaccineImage)
-            vaccinations.plotCanadaVaccinations()
+def loadOwidLocations() -> dict:
+    """Return the OWID locations, or None if they can't be loaded right now."""
+    try:
+        return global_vaccinations.getLocations()
+    except Exception:
+        logger.exception("Failed to load the OWID locations, indexing without them")
+        return None
+
+
+def buildLocationIndex(owidLocations: dict) -> LocationIndex:
+    index = LocationIndex(
+        covid_stats_plotter.historyStore.getAvailableCountries(),
+        covid_stats_plotter.historyStore.getAvailableRegions(),
+        owidLocations,
+        vaccinations.urlSuffix,
+    )
+    logger.info("Indexed %d locations", len(index))
+    return index
+
+
+def addOwidLocations() -> None:
+    global locationIndex, owidLocationsRetryAt
+    owidLocations = loadOwidLocations()
+    index = None
+    if owidLocations != None:
+        index = buildLocationIndex(owidLocations)
+    with locationIndexLock:
+        if index == None:
+            owidLocationsRetryAt = time.monotonic() + owidLocationsRetryInterval
         else:
-            images.append(global_vaccinations.countryVaccineImage)
-            global_vaccinations.plotCountryVaccinations(country)
+            locationIndex = index
+
+
+def getLocationIndex() -> LocationIndex:
+    global locationIndex, owidLocationsRetryAt
+    with locationIndexLock:
+        if locationIndex == None:
+            owidLocations = loadOwidLocations()
+            if owidLocations == None:
+                owidLocationsRetryAt = time.monotonic() + owidLocationsRetryInterval
+            locationIndex = buildLocationIndex(owidLocations or {})
+        elif owidLocationsRetryAt != None and time.monotonic() >= owidLocationsRetryAt:
+            # Retry off the handler thread so no command waits on the download
+            owidLocationsRetryAt = None
+            threading.Thread(target=addOwidLocations, daemon=True).start()
+        return locationIndex
+
+
+def resolveLocations(country=None, state=None) -> tuple:
+    """
+    Return the Location for country and state (None for None). Raises
+    LocationNotFound if a name matches nothing.
+    """
+    index = getLocationIndex()
+    countryLocation = None
+    stateLocation = None
+    if country != None:
+        countryLocation = index.getCountry(country)
+        if countryLocation == None:
+            raise LocationNotFound("Given country " + country + " not found")
     if state != None:
-        images.append(covid_stats_plotter.outputStateImage)
-        covid_stats_plotter.plotStateCases(state)
-        if vaccinations.plotVaccinations(state):
-            images.append(vaccinations.stateVaccineImage)
+        stateLocation = index.getRegion(state)
+        if stateLocation == None:
+            raise LocationNotFound("Given region " + state + " not found")
+    return countryLocation, stateLocation
+
+
+def getLocationNames(country=None, state=None) -> tuple:
+    """Return the names to store and pass around for what the user typed."""
+    countryLocation, stateLocation = resolveLocations(country, state)
+    return (
+        None if countryLocation == None else countryLocation.name,
+        None if stateLocation == None else stateLocation.name,
+    )
+
+
+def getChartList(country=None, state=None) -> list:
+    """Return (chart type, location, data version, spec builder) for each chart."""
+    countryLocation, stateLocation = resolveLocations(country, state)
+    charts = []
+    if countryLocation != None:
+        country = countryLocation.name
+        casesName = countryLocation.casesName
+        owidName = countryLocation.owidName
+        if casesName != None:
+            charts.append(
+                (
+                    "country_cases",
+                    country,
+                    covid_stats_plotter.getCountryDataVersion(casesName),
+                    lambda: covid_stats_plotter.getCountryCasesChartSpec(casesName),
+                )
+            )
+        if country == "Canada":
+            charts.append(
+                (
+                    "canada_vaccines",
+                    country,
+                    vaccinations.getCanadaDataVersion(),
+                    vaccinations.getCanadaChartSpec,
+                )
+            )
+        elif owidName != None:
+            charts.append(
+                (
+                    "country_vaccines",
+                    country,
+                    global_vaccinations.getCountryDataVersion(owidName),
+                    lambda: global_vaccinations.getCountryVaccinationChartSpec(
+                        owidName
+                    ),
+                )
+            )
+    if stateLocation != None:
+        state = stateLocation.name
+        regionName = stateLocation.casesName
+        provinceCode = stateLocation.provinceCode
+        if regionName != None:
+            charts.append(
+                (
+                    "state_cases",
+                    state,
+                    covid_stats_plotter.getStateDataVersion(regionName),
+                    lambda: covid_stats_plotter.getStateCasesChartSpec(regionName),
+                )
+            )
+        if provinceCode != None:
+            charts.append(
+                (
+                    "state_vaccines",
+                    state,
+                    vaccinations.getProvinceDataVersion(provinceCode),
+                    lambda: vaccinations.getProvinceChartSpec(provinceCode),
+                )
+            )
+    return charts
+
+
+def getGraphImages(country="canada", state="ontario") -> list:
+    with metrics.timed("graphs"):
+        keys = []
+        images = {}
+        missing = []
+        for chartType, location, version, getSpec in getChartList(country, state):
+            key = chartKey(chartType, location, version)
+            keys.append(key)
+            image = chartCache.get(key)
+            if image == None:
+                with metrics.timed("chart_spec", chart=chartType):
+                    missing.append((key, getSpec()))
+            else:
+                images[key] = image
+
+        # Render every chart that isn't cached in one batch so they run in parallel
+        if len(missing) > 0:
+            with metrics.timed("render"):
+                rendered = renderService.renderAll([spec for _, spec in missing])
+            for (key, _), image in zip(missing, rendered):
+                chartCache.put(key, image)
+                images[key] = image
+
+    logger.info(
+        "Chart cache hit rate: %.1f%% (%s)",
+        100.0 * chartCache.hitRate(),
+        chartCache.stats(),
+    )
+    return [images[key] for key in keys]
+
+
+async def fetchUpstreamData(country=None, state=None) -> None:
+    """Fetch every upstream dataset the report needs concurrently."""
+    countryLocation, stateLocation = resolveLocations(country, state)
+    historyStore = covid_stats_plotter.historyStore
+    fetches = []
+    if countryLocation != None:
+        if countryLocation.casesName != None:
+            fetches.append(
+                asyncRuntime.call(
+                    "covid19data",
+                    historyStore.getCountryHistory,
+                    countryLocation.casesName,
+                )
+            )
+        if countryLocation.name == "Canada":
+            fetches.append(
+                asyncRuntime.call(
+                    "covid19tracker", vaccinations.loadReport, vaccinations.urlCanada
+                )
+            )
+        elif countryLocation.owidName != None:
+            fetches.append(
+                asyncRuntime.call(
+                    "owid", global_vaccinations.getCountryData, countryLocation.owidName
+                )
+            )
+    if stateLocation != None:
+        if stateLocation.casesName != None:
+            fetches.append(
+                asyncRuntime.call(
+                    "covid19data",
+                    historyStore.getProvinceHistory,
+                    stateLocation.casesName,
+                )
+            )
+        if stateLocation.provinceCode != None:
+            provinceURL = vaccinations.getProvinceURL(stateLocation.provinceCode)
+            fetches.append(
+                asyncRuntime.call(
+                    "covid19tracker", vaccinations.loadReport, provinceURL
+                )
+            )
+    await asyncio.gather(*fetches)
+
+
+async def buildReportAsync(country=None, state=None) -> Report:
+    await fetchUpstreamData(country, state)
+    # With the data cached, rendering and the summary only cost CPU
+    images, summary = await asyncio.gather(
+        asyncRuntime.call("render", getGraphImages, country, state),
+        asyncRuntime.call("summary", getSummary, country, state),
+    )
+    return Report(images, summary)
 
-    imageFiles = []
-    for image in images:
-        ImageFile = open(image, "rb")
-        MediaImage = InputMediaPhoto(ImageFile)
-        imageFiles.append(MediaImage)
-        ImageFile.close()
-        os.remove(image)
 
-    return imageFiles
+async def replyWithReportAsync(
+    update: Update, country=None, state=None, errorText="", command="now"
+) -> None:
+    try:
+        location = getLocationLabel(country, state)
+        with metrics.timed("report", command=command, location=location):
+            report = await buildReportAsync(country, state)
+            await asyncRuntime.call(
+                "telegram", sendImages, update.message.reply_media_group, report.images
+            )
+            with metrics.timed("telegram_send", method="message"):
+                await asyncRuntime.call(
+                    "telegram",
+                    update.message.reply_text,
+                    report.summary,
+                    parse_mode="HTML",
+                )
+    except Exception:
+        logger.exception("Failed to build the report for %s %s", country, state)
+        await asyncRuntime.call("telegram", update.message.reply_text, errorText)
+
+
+def getLocationLabel(country=None, state=None) -> str:
+    return str(country) + "/" + str(state)
+
+
+def replyWithReport(
+    update: Update, country=None, state=None, errorText="", command="now"
+) -> None:
+    """
+    Reply with the graphs and summary. In async mode this returns straight away
+    and errorText is sent if the report fails; otherwise errors are raised.
+    """
+    prefetcher.record(country, state)
+    if asyncRuntime != None:
+        asyncRuntime.submit(
+            replyWithReportAsync(update, country, state, errorText, command)
+        )
+        return
+    location = getLocationLabel(country, state)
+    with metrics.timed("report", command=command, location=location):
+        sendImages(update.message.reply_media_group, getGraphImages(country, state))
+        summary = getSummary(country, state)
+        with metrics.timed("telegram_send", method="message"):
+            update.message.reply_text(summary, parse_mode="HTML")
 
 
 def getSummary(country=None, state=None) -> str:
+    # The summary reads the same data as the charts, so share their versions
+    versions = tuple(version for _, _, version, _ in getChartList(country, state))
+    key = chartKey("summary", getLocationLabel(country, state), versions)
+    summary = summaryCache.get(key)
+    if summary == None:
+        with metrics.timed("summary"):
+            summary = buildSummary(country, state).encode()
+        summaryCache.put(key, summary)
+    return summary.decode()
+
+
+def buildSummary(country=None, state=None) -> str:
+    countryLocation, stateLocation = resolveLocations(country, state)
     countrySummary = ""
     stateSummary = ""
-    if country != None:
-        country = country.lower()
-        countrySummary = covid_stats_plotter.getCountrySummary(country)
-        if country.lower() == "canada":
+    if countryLocation != None:
+        if countryLocation.casesName != None:
+            countrySummary = covid_stats_plotter.getCountrySummary(
+                countryLocation.casesName
+            )
+        if countryLocation.name == "Canada":
             countrySummary += "\n" + vaccinations.getCanadaSummary()
-        else:
-            countrySummary += "\n" + global_vaccinations.getCountrySummary(country)
+        elif countryLocation.owidName != None:
+            countrySummary += "\n" + global_vaccinations.getCountrySummary(
+                countryLocation.owidName
+            )
 
-    if state != None:
-        state = state.lower()
-        stateSummary = covid_stats_plotter.getRegionSummary(state)
-        stateSummary += "\n" + vaccinations.getSummary(state)
+    if stateLocation != None:
+        if stateLocation.casesName != None:
+            stateSummary = covid_stats_plotter.getRegionSummary(stateLocation.casesName)
+        if stateLocation.provinceCode != None:
+            stateSummary += "\n" + vaccinations.getSummary(stateLocation.provinceCode)
 
     return countrySummary + stateSummary
 
 
-def alarm(context: CallbackContext, country="canada", state="ontario") -> None:
-    """Send the alarm message."""
+def buildReport(country=None, state=None) -> Report:
+    if asyncRuntime != None:
+        return asyncRuntime.run(buildReportAsync(country, state))
+    return Report(getGraphImages(country, state), getSummary(country, state))
+
+
+def sendImages(sendMediaGroup, images: list) -> list:
+    """
+    Send images with sendMediaGroup(media), reusing the file_id of any image
+    that was uploaded before and recording the file_ids of new uploads.
+    """
+    fileIds = [fileIdCache.get(image) for image in images]
+    media = [
+        InputMediaPhoto(image if fileId == None else fileId)
+        for image, fileId in zip(images, fileIds)
+    ]
     try:
-        context.bot.send_chat_action(
-            context.job.context, action=ChatAction.UPLOAD_PHOTO
-        )
-        context.bot.send_media_group(context.job.context, getGraphs(country, state))
-        context.bot.send_message(
-            context.job.context, text=getSummary(country, state), parse_mode="HTML"
-        )
-    except:
-        context.bot.send_message(
-            context.job.context, text="Sorry, encountered an error :("
+        with metrics.timed("telegram_send", method="media_group"):
+            messages = sendMediaGroup(media)
+    except BadRequest:
+        if fileIds.count(None) == len(fileIds):
+            raise
+        # A stored file_id was rejected, so forget them and upload the bytes
+        for image in images:
+            fileIdCache.invalidate(image)
+        return sendImages(sendMediaGroup, images)
+    for image, fileId, message in zip(images, fileIds, messages):
+        if fileId == None:
+            fileIdCache.put(image, message.photo[-1].file_id)
+    return messages
+
+
+def sendReport(bot, chat_id, report: Report) -> None:
+    sendMediaGroup = lambda media: bot.send_media_group(chat_id, media)
+    sent = False
+    if not report.uploaded:
+        # Hold other chats back until the first upload has produced file_ids
+        with report.uploadLock:
+            if not report.uploaded:
+                sendImages(sendMediaGroup, report.images)
+                report.uploaded = True
+                sent = True
+    if not sent:
+        sendImages(sendMediaGroup, report.images)
+    with metrics.timed("telegram_send", method="message"):
+        bot.send_message(chat_id, text=report.summary, parse_mode="HTML")
+
+
+def sendScheduledReport(bot, chat_id, country="canada", state="ontario") -> None:
+    prefetcher.record(country, state)
+    location = getLocationLabel(country, state)
+    try:
+        with metrics.timed("report", command="scheduled", location=location):
+            bot.send_chat_action(chat_id, action=ChatAction.UPLOAD_PHOTO)
+            report = reportFanout.getReport(country, state)
+            sendReport(bot, chat_id, report)
+    except Exception:
+        logger.exception("Failed to send the scheduled report for %s", location)
+        bot.send_message(chat_id, text="Sorry, encountered an error :(")
+
+
+reportFanout = ReportFanout(buildReport)
+
+
+def refreshUpstreamData() -> None:
+    """Drop the cached upstream data so the next report refetches it."""
+    covid_stats_plotter.historyStore.refresh()
+    vaccinations.reportCache.invalidate()
+    vaccinations.latestRecordCache.invalidate()
+
+
+prefetcher = Prefetcher(
+    buildReport,
+    refreshUpstreamData,
+    topN=prefetchTopN,
+    interval=prefetchInterval,
+    publishTimes=prefetchPublishTimes,
+)
+
+
+def getNextDailyFire(time_of_day: str, now: float) -> float:
+    timeOfDay = datetime.datetime.strptime(time_of_day, "%H:%M").time()
+    nowUTC = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+    nextFire = datetime.datetime.combine(
+        nowUTC.date(), timeOfDay, tzinfo=datetime.timezone.utc
+    )
+    if nextFire.timestamp() <= now:
+        nextFire += datetime.timedelta(days=1)
+    return nextFire.timestamp()
+
+
+def getNextFire(subscription: Subscription, now: float) -> float:
+    if subscription.kind == "daily":
+        return getNextDailyFire(subscription.time_of_day, now)
+    return now + subscription.interval
+
+
+def runDueSubscriptions(context: CallbackContext) -> None:
+    """Send every subscription whose next fire time has passed."""
+    now = time.time()
+    due = subscriptionStore.getDue(now)
+    if not due:
+        return
+    for subscription in due:
+        subscription.next_fire = getNextFire(subscription, now)
+    subscriptionStore.setNextFires(due)
+    for subscription in due:
+        context.dispatcher.run_async(
+            sendScheduledReport,
+            context.bot,
+            subscription.chat_id,
+            subscription.country,
+            subscription.state,
         )
 
 
+def startSubscriptions(job_queue) -> None:
+    logger.info("Serving %d stored subscriptions", subscriptionStore.count())
+    job_queue.run_repeating(
+        runDueSubscriptions, subscriptionTickSeconds, first=0, name="subscriptions"
+    )
+
+
 def list_jobs(update: Update, context: CallbackContext) -> None:
-    current_jobs = context.job_queue.get_jobs_by_name(str(update.message.chat_id))
+    subscriptions = subscriptionStore.listForChat(update.message.chat_id)
     outString = ""
-    if not current_jobs:
+    if not subscriptions:
         outString = "No scheduled jobs"
     else:
         count = 1
-        for job in current_jobs:
-            outString += str(count) + ": " + str(job.trigger) + "\n"
+        for subscription in subscriptions:
+            outString += str(count) + ": " + str(subscription) + "\n"
             count += 1
     update.message.reply_text(outString)
 
 
 def delete_job(update: Update, context: CallbackContext) -> None:
-    current_jobs = context.job_queue.get_jobs_by_name(str(update.message.chat_id))
-    if not current_jobs:
+    subscriptions = subscriptionStore.listForChat(update.message.chat_id)
+    if not subscriptions:
         update.message.reply_text("No scheduled jobs")
         return
     else:
         try:
-            jobs = []
+            selected = []
             if str(context.args[0]) == "all":
-                jobs = current_jobs
+                selected = subscriptions
             else:
-                jobs.append(current_jobs[int(context.args[0]) - 1])
-            for job in jobs:
-                update.message.reply_text("Deleting job: " + str(job.trigger))
-                job.schedule_removal()
+                index = int(context.args[0]) - 1
+                if index < 0:
+                    raise IndexError()
+                selected.append(subscriptions[index])
+            for subscription in selected:
+                update.message.reply_text("Deleting job: " + str(subscription))
+                subscriptionStore.remove(subscription.id)
         except (IndexError, ValueError):
             update.message.reply_text("Job not found.")
 
@@ -157,15 +598,16 @@ def get_once(update: Update, context: CallbackContext) -> None:
             state = None
         if len(context.args) >= 2:
             state = str(" ".join(context.args[1:])).lower()
+        country, state = getLocationNames(country, state)
         update.message.reply_chat_action(action=ChatAction.UPLOAD_PHOTO)
-        update.message.reply_media_group(getGraphs(country=country, state=state))
-        update.message.reply_text(
-            getSummary(country=country, state=state), parse_mode="HTML"
-        )
+        replyWithReport(update, country, state, "Country or State not found", "now")
     except (IndexError, ValueError):
         update.message.reply_text("Usage: /now [country] [region]")
-    except:
+    except LocationNotFound:
         update.message.reply_text("Country or State not found")
+    except Exception:
+        logger.exception("Failed to send the report for %s %s", country, state)
+        update.message.reply_text("Sorry, encountered an error :(")
 
 
 def daily(update: Update, context: CallbackContext) -> None:
@@ -174,7 +616,7 @@ def daily(update: Update, context: CallbackContext) -> None:
     try:
         # args[0] should contain the time of day
         time_format = "%H:%M"
-        time = datetime.datetime.strptime(str(context.args[0]), time_format)
+        timeOfDay = datetime.datetime.strptime(str(context.args[0]), time_format)
 
         country = "canada"
         state = "ontario"
@@ -183,11 +625,15 @@ def daily(update: Update, context: CallbackContext) -> None:
             state = None
         if len(context.args) >= 3:
             state = str(" ".join(context.args[2:])).lower()
-        getDataFunc = lambda context: alarm(
-            context=context, country=country, state=state
-        )
-        context.job_queue.run_daily(
-            getDataFunc, time.time(), context=chat_id, name=str(chat_id)
+        country, state = getLocationNames(country, state)
+        time_of_day = timeOfDay.strftime(time_format)
+        subscriptionStore.add(
+            chat_id,
+            "daily",
+            country,
+            state,
+            getNextDailyFire(time_of_day, time.time()),
+            time_of_day=time_of_day,
         )
 
         text = "Schedule successfully set!"
@@ -197,6 +643,8 @@ def daily(update: Update, context: CallbackContext) -> None:
         update.message.reply_text(
             "Usage: /daily <HH:MM Time in UTC> [Country] [Region]"
         )
+    except LocationNotFound:
+        update.message.reply_text("Country or State not found")
 
 
 def repeat_timer(update: Update, context: CallbackContext) -> None:
@@ -216,12 +664,10 @@ def repeat_timer(update: Update, context: CallbackContext) -> None:
             state = None
         if len(context.args) >= 3:
             state = str(" ".join(context.args[2:])).lower()
+        country, state = getLocationNames(country, state)
 
-        getDataFunc = lambda context: alarm(
-            context=context, country=country, state=state
-        )
-        context.job_queue.run_repeating(
-            getDataFunc, due, context=chat_id, name=str(chat_id)
+        subscriptionStore.add(
+            chat_id, "repeat", country, state, time.time() + due, interval=due
         )
 
         text = "Recurrance successfully set!"
@@ -229,6 +675,8 @@ def repeat_timer(update: Update, context: CallbackContext) -> None:
 
     except (IndexError, ValueError):
         update.message.reply_text("Usage: /repeat [hours] [Country] [Region]")
+    except LocationNotFound:
+        update.message.reply_text("Country or State not found")
 
 
 def country_data(update: Update, context: CallbackContext) -> None:
@@ -236,9 +684,14 @@ def country_data(update: Update, context: CallbackContext) -> None:
     chat_id = update.message.chat_id
     try:
         # args[0] should contain the country
-        country = " ".join(context.args).title()
-        update.message.reply_media_group(getGraphs(country=country, state=None))
-        update.message.reply_text(getSummary(country=country), parse_mode="HTML")
+        country, _ = getLocationNames(country=" ".join(context.args))
+        replyWithReport(
+            update,
+            country=country,
+            errorText="Usage: /country [country]\n"
+            "Check the list of countries to see if your input is not valid",
+            command="country",
+        )
 
     except:
         update.message.reply_text(
@@ -247,10 +700,57 @@ def country_data(update: Update, context: CallbackContext) -> None:
         )
 
 
+def getListPage(kind: str, prefix: str, page: int) -> tuple:
+    """Return the text and inline keyboard (or None) for a page of a list."""
+    pages = paginatedLists[kind].getPages(prefix)
+    if len(pages) == 0:
+        return "No " + kind + " starts with " + prefix, None
+    page = max(0, min(page, len(pages) - 1))
+    if len(pages) == 1:
+        return pages[page], None
+    # The prefix is normalized, so it never contains the ":" separator
+    callbackData = "list:" + kind + ":{}:" + normalizeName(prefix or "")
+    buttons = []
+    if page > 0:
+        buttons.append(
+            InlineKeyboardButton("« Prev", callback_data=callbackData.format(page - 1))
+        )
+    buttons.append(
+        InlineKeyboardButton(
+            str(page + 1) + "/" + str(len(pages)),
+            callback_data=callbackData.format(page),
+        )
+    )
+    if page < len(pages) - 1:
+        buttons.append(
+            InlineKeyboardButton("Next »", callback_data=callbackData.format(page + 1))
+        )
+    return pages[page], InlineKeyboardMarkup([buttons])
+
+
+def sendListPage(update: Update, context: CallbackContext, kind: str) -> None:
+    prefix = None
+    if len(context.args) > 0:
+        prefix = " ".join(context.args)
+    text, keyboard = getListPage(kind, prefix, 0)
+    update.message.reply_text(text, reply_markup=keyboard)
+
+
+def list_page(update: Update, context: CallbackContext) -> None:
+    """Show the page picked with the buttons under a list."""
+    query = update.callback_query
+    _, kind, page, prefix = query.data.split(":", 3)
+    query.answer()
+    text, keyboard = getListPage(kind, prefix or None, int(page))
+    try:
+        query.edit_message_text(text, reply_markup=keyboard)
+    except BadRequest:
+        # Pressing the current page leaves the message unchanged
+        pass
+
+
 def country_list(update: Update, context: CallbackContext) -> None:
-    """Add a job to the queue."""
-    chat_id = update.message.chat_id
-    update.message.reply_text(covid_stats_plotter.getListOfCountries())
+    sendListPage(update, context, "country")
 
 
 def region_data(update: Update, context: CallbackContext) -> None:
@@ -258,11 +758,16 @@ def region_data(update: Update, context: CallbackContext) -> None:
     chat_id = update.message.chat_id
     try:
         # args[0] should contain the region
-        region = " ".join(context.args).title()
+        _, region = getLocationNames(state=" ".join(context.args))
 
         chat_id = update.message.chat_id
-        update.message.reply_media_group(getGraphs(state=region, country=None))
-        update.message.reply_text(getSummary(state=region), parse_mode="HTML")
+        replyWithReport(
+            update,
+            state=region,
+            errorText="Usage: /region [region]\n"
+            "Check the list of regions to see if your input is not valid",
+            command="region",
+        )
 
     except:
         update.message.reply_text(
@@ -272,13 +777,155 @@ def region_data(update: Update, context: CallbackContext) -> None:
 
 
 def region_list(update: Update, context: CallbackContext) -> None:
-    """Add a job to the queue."""
-    chat_id = update.message.chat_id
-    update.message.reply_text(covid_stats_plotter.getListOfRegions())
+    sendListPage(update, context, "region")
+
+
+def getProvinceGridImage(reports: dict) -> bytes:
+    """
+    The small-multiples chart of every province, cached like the others.
+    reports is the batch from vaccinations.loadAllReports().
+    """
+    version = vaccinations.getAllProvincesDataVersion(reports)
+    key = chartKey("province_grid", "Canada", version)
+    image = chartCache.get(key)
+    if image == None:
+        with metrics.timed("chart_spec", chart="province_grid"):
+            spec = vaccinations.getAllProvincesChartSpec(reports)
+        with metrics.timed("render"):
+            image = renderService.renderAll([spec])[0]
+        chartCache.put(key, image)
+    return image
+
+
+async def canadaAllAsync(update: Update) -> None:
+    try:
+        with metrics.timed("report", command="canada_all", location="Canada/all"):
+            reports = await asyncRuntime.call(
+                "covid19tracker", vaccinations.loadAllReports
+            )
+            image, summary = await asyncio.gather(
+                asyncRuntime.call("render", getProvinceGridImage, reports),
+                asyncRuntime.call(
+                    "summary", vaccinations.getAllProvincesSummary, reports
+                ),
+            )
+            with metrics.timed("telegram_send", method="photo"):
+                await asyncRuntime.call("telegram", update.message.reply_photo, image)
+            with metrics.timed("telegram_send", method="message"):
+                await asyncRuntime.call(
+                    "telegram", update.message.reply_text, summary, parse_mode="HTML"
+                )
+    except Exception:
+        logger.exception("Failed to send the all-province report")
+        await asyncRuntime.call(
+            "telegram", update.message.reply_text, "Sorry, encountered an error :("
+        )
+
+
+def canada_all(update: Update, context: CallbackContext) -> None:
+    """Compare the vaccinations of every province in one chart and table."""
+    update.message.reply_chat_action(action=ChatAction.UPLOAD_PHOTO)
+    if asyncRuntime != None:
+        # Leave the dispatcher thread free while the batch is fetched and sent
+        asyncRuntime.submit(canadaAllAsync(update))
+        return
+    try:
+        with metrics.timed("report", command="canada_all", location="Canada/all"):
+            # One concurrent batch fetches every report the chart and table use
+            reports = vaccinations.loadAllReports()
+            image = getProvinceGridImage(reports)
+            summary = vaccinations.getAllProvincesSummary(reports)
+            with metrics.timed("telegram_send", method="photo"):
+                update.message.reply_photo(image)
+            with metrics.timed("telegram_send", method="message"):
+                update.message.reply_text(summary, parse_mode="HTML")
+    except Exception:
+        logger.exception("Failed to send the all-province report")
+        update.message.reply_text("Sorry, encountered an error :(")
+
+
+def stats(update: Update, context: CallbackContext) -> None:
+    """Send the per-stage latency and cache metrics to the bot's admins."""
+    if update.message.chat_id not in statsChatIds:
+        update.message.reply_text("Sorry, /stats is only available to admins")
+        return
+    summary = metrics.registry.summary()
+    if summary == "":
+        summary = "No metrics recorded yet"
+    for page in paginate(summary.split("\n")):
+        update.message.reply_text(page)
+
+
+def collectCacheStats() -> list:
+    caches = {
+        "chart": chartCache.stats(),
+        "summary": summaryCache.stats(),
+        "file_id": fileIdCache.stats(),
+    }
+    if vaccinations.isLoaded():
+        caches["covid19tracker"] = vaccinations.reportCache.stats()
+        caches["covid19tracker_latest"] = vaccinations.latestRecordCache.stats()
+    gauges = []
+    for cache, cacheStats in caches.items():
+        for name in ("hits", "misses", "entries"):
+            gauges.append(("cache_" + name, {"cache": cache}, cacheStats[name]))
+    return gauges
+
+
+metrics.registry.addCollector(collectCacheStats)
+
+
+def instrumented(command: str, handler):
+    """Wrap a command handler so it is timed, and sometimes profiled."""
+
+    def run(update: Update, context: CallbackContext) -> None:
+        with metrics.profiled(command), metrics.timed("command", command=command):
+            handler(update, context)
+
+    return run
+
+
+def getOption(name: str, default: str = None) -> str:
+    """Return the value given as --name=value on the command line, or default."""
+    prefix = "--" + name + "="
+    for arg in sys.argv[1:]:
+        if arg.startswith(prefix):
+            return arg[len(prefix) :]
+    return default
+
+
+def warmUp() -> None:
+    """Import the data modules and index every location before anyone asks."""
+    start = time.perf_counter()
+    try:
+        for module in (covid_stats_plotter, vaccinations, global_vaccinations):
+            module.load()
+        getLocationIndex()
+    except Exception:
+        logger.exception("Warm-up failed, loading on first use instead")
+        return
+    logger.info("Warmed up in %.1fs", time.perf_counter() - start)
 
 
 def main() -> None:
     """Run bot."""
+    global renderService, subscriptionStore, fileIdCache, asyncRuntime
+    profile = getOption("render-profile", renderProfile)
+    if profile != renderProfile:
+        # Check the name now rather than in every pool worker
+        chart_output.setRenderProfile(profile)
+    metrics.profileSampleRate = float(getOption("profile-sample", "0"))
+    metricsPort = getOption("metrics-port")
+    if metricsPort != None:
+        metrics.startHttpServer(int(metricsPort))
+    renderService = RenderService(workers=renderWorkers, renderProfile=profile)
+    subscriptionStore = SubscriptionStore(subscriptionDbFile)
+    fileIdCache = FileIdCache(fileIdDbFile)
+    fileIdCache.prune(fileIdMaxAge)
+    if "--async" in sys.argv[1:]:
+        asyncRuntime = AsyncRuntime(upstreamLimits)
+        asyncRuntime.start()
+
     # Create the Updater and pass it your bot's token.
     updater = Updater(m_token)
 
@@ -286,26 +933,42 @@ def main() -> None:
     dispatcher = updater.dispatcher
 
     # on different commands - answer in Telegram
-    dispatcher.add_handler(CommandHandler("start", help))
-    dispatcher.add_handler(CommandHandler("help", help))
-    dispatcher.add_handler(CommandHandler("now", get_once))
-    dispatcher.add_handler(CommandHandler("repeat", repeat_timer))
-    dispatcher.add_handler(CommandHandler("daily", daily))
-    dispatcher.add_handler(CommandHandler("country", country_data))
-    dispatcher.add_handler(CommandHandler("country_list", country_list))
-    dispatcher.add_handler(CommandHandler("region", region_data))
-    dispatcher.add_handler(CommandHandler("region_list", region_list))
-    dispatcher.add_handler(CommandHandler("info", info))
-    dispatcher.add_handler(CommandHandler("jobs", list_jobs))
-    dispatcher.add_handler(CommandHandler("delete", delete_job))
+    commands = {
+        "start": help,
+        "help": help,
+        "now": get_once,
+        "repeat": repeat_timer,
+        "daily": daily,
+        "country": country_data,
+        "country_list": country_list,
+        "region": region_data,
+        "region_list": region_list,
+        "canada_all": canada_all,
+        "info": info,
+        "jobs": list_jobs,
+        "delete": delete_job,
+        "stats": stats,
+    }
+    for command, handler in commands.items():
+        dispatcher.add_handler(CommandHandler(command, instrumented(command, handler)))
+    dispatcher.add_handler(CallbackQueryHandler(list_page, pattern="^list:"))
+
+    # Serve the subscriptions saved before the last shutdown
+    startSubscriptions(updater.job_queue)
 
     # Start the Bot
     updater.start_polling()
+    prefetcher.start()
+    if warmUpOnStart and "--no-warm-up" not in sys.argv[1:]:
+        threading.Thread(target=warmUp, name="warm_up", daemon=True).start()
 
     # Block until you press Ctrl-C or the process receives SIGINT, SIGTERM or
     # SIGABRT. This should be used most of the time, since start_polling() is
     # non-blocking and will stop the bot gracefully.
     updater.idle()
+    prefetcher.stop()
+    if asyncRuntime != None:
+        asyncRuntime.stop()
 
 
 if __name__ == "__main__":
@@ -1,41 +1,180 @@
 #!/usr/bin/env python3
+import threading
+import time
 from covid.api import CovId19Data
-from matplotlib import pyplot as plt
+from covid.lib.helper import convert_label_to_id
 from matplotlib import ticker as pltticker
 import pandas as pd
 import numpy as np
 import prettytable as pt
 from countryinfo import CountryInfo
+import metrics
+from response_cache import InFlight
+from chart_output import newFigure, figureToPng, FigureTemplate, getFigureTemplate
+import timeseries
 
-outputStateImage = "state_cases.png"
-outputCountryImage = "country_cases.png"
 
+class HistoryStore:
+    """
+    Holds one CovId19Data client and caches the history lookups per location.
 
-def getSummary(res, title, population=None):
+    The client and the cached histories (and their HistoryIndex) are dropped
+    after refreshInterval seconds. The lock only guards the bookkeeping: the
+    client is built and histories are fetched and indexed outside it, once for
+    all the callers asking for the same thing at the same time. Tests and
+    benchmarks can swap in a fake with setHistoryStore().
+    """
+
+    def __init__(self, refreshInterval: float = 3600.0, clientFactory=None) -> None:
+        self.refreshInterval = refreshInterval
+        self.clientFactory = clientFactory
+        if self.clientFactory == None:
+            self.clientFactory = lambda: CovId19Data(force=False)
+        self.client = None
+        self.loadedAt = 0.0
+        self.histories = {}
+        self.indexes = {}
+        self.inFlight = {}
+        self.lock = threading.Lock()
+
+    def singleFlight(self, key: tuple, getCached, load):
+        """
+        Return getCached() unless it is None, else the result of load(), which
+        runs once for every caller that asks for key while it is running.
+        getCached runs under the lock and load outside it.
+        """
+        with self.lock:
+            value = getCached()
+            if value != None:
+                return value
+            flight = self.inFlight.get(key)
+            isLeader = flight == None
+            if isLeader:
+                flight = InFlight()
+                self.inFlight[key] = flight
+
+        if not isLeader:
+            flight.done.wait()
+            if flight.error != None:
+                raise flight.error
+            return flight.entry
+
+        try:
+            flight.entry = load()
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                del self.inFlight[key]
+            flight.done.set()
+        return flight.entry
+
+    def getFreshClient(self):
+        if time.monotonic() - self.loadedAt >= self.refreshInterval:
+            return None
+        return self.client
+
+    def getClient(self):
+        return self.singleFlight(("client",), self.getFreshClient, self.loadClient)
+
+    def loadClient(self):
+        with metrics.timed("upstream", source="covid19data", call="load"):
+            client = self.clientFactory()
+        with self.lock:
+            self.client = client
+            self.loadedAt = time.monotonic()
+            self.histories = {}
+            self.indexes = {}
+        return client
+
+    def refresh(self) -> None:
+        """Drop the client and cached histories so the next lookup refetches."""
+        with self.lock:
+            self.client = None
+
+    def getHistory(self, kind: str, name: str) -> dict:
+        """Return the raw API result for kind ("country" or "province")."""
+        client = self.getClient()
+        key = (kind, name.lower())
+        return self.singleFlight(
+            ("history",) + key,
+            lambda: self.histories.get(key),
+            lambda: self.loadHistory(client, kind, name),
+        )
+
+    def loadHistory(self, client, kind: str, name: str) -> dict:
+        with metrics.timed("upstream", source="covid19data", call="history"):
+            if kind == "country":
+                history = client.get_history_by_country(name)
+            else:
+                history = client.get_history_by_province(name)
+        with self.lock:
+            # Unless the client was replaced meanwhile, which drops the cache
+            if self.client is client:
+                self.histories[(kind, name.lower())] = history
+        return history
+
+    def getIndex(self, kind: str, name: str) -> timeseries.HistoryIndex:
+        history = self.getHistory(kind, name)
+        key = (kind, name.lower())
+        return self.singleFlight(
+            ("index",) + key,
+            lambda: self.indexes.get(key),
+            lambda: self.buildIndex(history, kind, name),
+        )
+
+    def buildIndex(self, history: dict, kind: str, name: str):
+        dbKey = convert_label_to_id(name)
+        index = timeseries.HistoryIndex(history[dbKey]["history"])
+        key = (kind, name.lower())
+        with self.lock:
+            if self.histories.get(key) is history:
+                self.indexes[key] = index
+        return index
+
+    def getCountryIndex(self, country: str) -> timeseries.HistoryIndex:
+        return self.getIndex("country", country)
+
+    def getProvinceIndex(self, province: str) -> timeseries.HistoryIndex:
+        return self.getIndex("province", province)
+
+    def getCountryHistory(self, country: str) -> dict:
+        return self.getHistory("country", country)
+
+    def getProvinceHistory(self, province: str) -> dict:
+        return self.getHistory("province", province)
+
+    def getAvailableCountries(self):
+        return self.getClient().show_available_countries()
+
+    def getAvailableRegions(self):
+        return self.getClient().show_available_regions()
+
+
+historyStore = HistoryStore()
+
+
+def setHistoryStore(store) -> None:
+    global historyStore
+    historyStore = store
+
+
+def getSummary(index: timeseries.HistoryIndex, title, population=None):
     summaryMapToday = {
-        "- Cases": "confirmed",
-        "- Deaths": "deaths",
+        "- Cases": index.confirmed,
+        "- Deaths": index.deaths,
     }
     summaryMapTotal = {
-        "- Cases": "confirmed",
-        "- Deaths": "deaths",
+        "- Cases": index.confirmed,
+        "- Deaths": index.deaths,
     }
-    current_index = -1
-    currentData = res[list(res)[current_index]]
-    while (
-        currentData["change_confirmed"] == "na" or currentData["change_deaths"] == "na"
-    ) or (
-        float(currentData["change_confirmed"]) == 0.0
-        and float(currentData["change_deaths"]) == 0.0
-    ):
-        current_index -= 1
-        try:
-            currentData = res[list(res)[current_index]]
-        except:
-            return "Couldn't find valid data."
+    current_index = index.lastValidIndex
+    if current_index == None:
+        return "Couldn't find valid data."
+    previous_index = index.previousIndex
 
-    secondLastData = res[list(res)[current_index - 1]]
-    date = pd.to_datetime(list(res)[current_index]).date()
+    date = index.dates[current_index].date()
     outputString = (
         "<b>Summary for " + title + "</b>\n<i>(as of " + str(date) + ")</i>\n"
     )
@@ -43,18 +182,17 @@ def getSummary(res, title, population=None):
     table.align["Stat"] = "l"
     table.align["Count"] = "r"
     table.add_row(["Today", ""])
-    for key, value in summaryMapToday.items():
-        if value in currentData:
-            outputNum = format(currentData[value] - secondLastData[value], ",d")
-            table.add_row([key, outputNum])
+    for key, values in summaryMapToday.items():
+        previous = 0 if previous_index == None else values[previous_index]
+        outputNum = format(int(values[current_index] - previous), ",d")
+        table.add_row([key, outputNum])
     table.add_row(["Total", ""])
-    for key, value in summaryMapTotal.items():
-        if value in currentData:
-            outputNum = format(currentData[value], ",d")
-            table.add_row([key, outputNum])
-        if value == "confirmed" and population != None:
+    for key, values in summaryMapTotal.items():
+        outputNum = format(int(values[current_index]), ",d")
+        table.add_row([key, outputNum])
+        if values is index.confirmed and population != None:
             pop_per_mil = population / 1000000.0
-            cases_per_mil = format(int((currentData[value] / pop_per_mil)), ",d")
+            cases_per_mil = format(int((values[current_index] / pop_per_mil)), ",d")
             table.add_row(["- Cases/mil", cases_per_mil])
     if len(summaryMapToday.items()) > 0:
         outputString += f"<pre>{table}</pre>"
@@ -63,65 +201,70 @@ def getSummary(res, title, population=None):
 
 
 def getCountrySummary(country="canada"):
-    covid_api = CovId19Data(force=False)
-    country_key = country.lower().replace(" ", "_")
-    res = covid_api.get_history_by_country(country)[country_key]["history"]
+    index = historyStore.getCountryIndex(country)
     population = None
     try:
         countryData = CountryInfo(country)
         population = countryData.population()
     except KeyError:
         print("Counldn't find the population for " + country)
-    return getSummary(res, country, population)
+    return getSummary(index, country, population)
 
 
 def getRegionSummary(region="Ontario"):
-    covid_api = CovId19Data(force=False)
-    region_key = region.lower().replace(" ", "_")
-    res = covid_api.get_history_by_province(region)[region_key]["history"]
-    return getSummary(res, region)
+    return getSummary(historyStore.getProvinceIndex(region), region)
+
+
+def getHistoryVersion(index: timeseries.HistoryIndex) -> tuple:
+    return (len(index), str(index.dates[-1]))
+
+
+def getCountryDataVersion(country="canada") -> tuple:
+    return getHistoryVersion(historyStore.getCountryIndex(country))
+
+
+def getStateDataVersion(state="ontario") -> tuple:
+    return getHistoryVersion(historyStore.getProvinceIndex(state))
 
 
 def getListOfCountries():
-    covid_api = CovId19Data(force=False)
-    outputString = ""
-    for country in covid_api.show_available_countries():
-        outputString += country + "\n"
-    return outputString
+    return "".join(country + "\n" for country in historyStore.getAvailableCountries())
 
 
 def getListOfRegions():
-    covid_api = CovId19Data(force=False)
-    outputString = ""
-    for country in covid_api.show_available_regions():
-        outputString += country + "\n"
-    return outputString
+    return "".join(region + "\n" for region in historyStore.getAvailableRegions())
 
 
-def plotCountryCases(country="canada"):
-    covid_api = CovId19Data(force=False)
-    res = covid_api.get_history_by_country(country)
+def getCountryCasesChartSpec(country="canada") -> dict:
+    index = historyStore.getCountryIndex(country)
     title = "COVID Cases for " + country
-    plotData(res, country, title.title(), outputCountryImage)
+    return getCasesChartSpec(index, title.title())
 
 
-def plotStateCases(state="ontario"):
-    covid_api = CovId19Data(force=False)
-    res = covid_api.get_history_by_province(state)
+def getStateCasesChartSpec(state="ontario") -> dict:
+    index = historyStore.getProvinceIndex(state)
     title = "COVID Cases for " + state
-    plotData(res, state, title.title(), outputStateImage)
+    return getCasesChartSpec(index, title.title())
+
+
+def plotCountryCases(country="canada") -> bytes:
+    return renderCasesChart(getCountryCasesChartSpec(country))
+
 
+def plotStateCases(state="ontario") -> bytes:
+    return renderCasesChart(getStateCasesChartSpec(state))
 
-def plottingfunction(date, cases, deaths, title, outputImage) -> None:
-    fig, ax = plt.subplots()
-    ax.set_title(title + " (7-day Average)")
+
+def buildCasesTemplate(date, cases, deaths) -> FigureTemplate:
+    fig = newFigure()
+    ax = fig.subplots()
     lns1 = ax.plot(date, cases, label="Cases")
     ax.set_ylabel("Cases")
     ax.get_yaxis().set_major_formatter(
         pltticker.FuncFormatter(lambda x, p: format(int(x), ","))
     )
     ax.legend()
-    plt.xticks(rotation=45)
+    ax.tick_params(axis="x", labelrotation=45)
     ax2 = ax.twinx()
     lns2 = ax2.plot(date, deaths, "r", label="Deaths")
     ax2.get_yaxis().set_major_formatter(
@@ -132,39 +275,39 @@ def plottingfunction(date, cases, deaths, title, outputImage) -> None:
     labs = [l.get_label() for l in lns]
     ax.legend(lns, labs, loc=0)
     fig.subplots_adjust(bottom=0.2)
-    fig.savefig(outputImage, format="png", dpi=300, bbox_inches="tight")
-    plt.close()
-
-
-def plotData(res, key, title="COVID Cases", outputImage="current_plot.png"):
-    days = []
-    y_data = []
-    y2_data = []
-    movingWindow_index = 0
-    index = 0
-    windowSize = 7
-    movingWindow = windowSize * [0]
-    movingWindow2 = windowSize * [0]
-    last = 0
-    last2 = 0
+    return FigureTemplate(fig, [ax, ax2], {"cases": lns1[0], "deaths": lns2[0]})
+
+
+def plottingfunction(date, cases, deaths, title) -> bytes:
+    template = getFigureTemplate(
+        "cases", lambda: buildCasesTemplate(date, cases, deaths)
+    )
+    fig = template.update(
+        title + " (7-day Average)", date, {"cases": cases, "deaths": deaths}
+    )
+    return figureToPng(fig)
+
+
+def getCasesChartSpec(index: timeseries.HistoryIndex, title="COVID Cases") -> dict:
+    """Compute the 7-day averages as NumPy series for renderCasesChart."""
+    return {
+        "chart": "cases",
+        "title": title,
+        "dates": index.dates,
+        "cases": timeseries.rollingMean(timeseries.dailyChange(index.confirmed)),
+        "deaths": timeseries.rollingMean(timeseries.dailyChange(index.deaths)),
+    }
+
+
+def renderCasesChart(spec: dict) -> bytes:
+    days = pd.to_datetime(spec["dates"])
+    return plottingfunction(days, spec["cases"], spec["deaths"], spec["title"])
+
+
+def plotData(res, key, title="COVID Cases") -> bytes:
     dbKey = key.lower().replace(" ", "_")
-    print(dbKey)
-    for day, data in res[dbKey]["history"].items():
-        days.append(day)
-        confirmed = data["confirmed"]
-        deaths = data["deaths"]
-        movingWindow[index] = confirmed - last
-        movingWindow2[index] = deaths - last2
-        last = confirmed
-        last2 = deaths
-        y_data.append(sum(movingWindow) / len(movingWindow))
-        y2_data.append(sum(movingWindow2) / len(movingWindow2))
-
-        movingWindow_index = index
-        index = 0 if (index == (windowSize - 1)) else (index + 1)
-
-    days = pd.to_datetime(days)
-    plottingfunction(days, y_data, y2_data, title, outputImage)
+    index = timeseries.HistoryIndex(res[dbKey]["history"])
+    return renderCasesChart(getCasesChartSpec(index, title))
 
 
 def main():
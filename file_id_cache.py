@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Maps chart content hashes to the Telegram file_ids returned after upload.
+
+Once an image has been uploaded, later sends of the exact same bytes can use
+its file_id instead of uploading it again. A changed chart has a different
+hash, so it is uploaded afresh. Entries are kept in SQLite when a path is
+given so they survive restarts, and unused entries can be pruned by age.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+
+fileIdSchema = """
+CREATE TABLE IF NOT EXISTS file_ids (
+    content_hash TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    uploaded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS file_ids_by_uploaded_at ON file_ids (uploaded_at);
+"""
+
+
+def contentHash(image: bytes) -> str:
+    return hashlib.sha256(image).hexdigest()
+
+
+class FileIdCache:
+    def __init__(self, path: str = None) -> None:
+        """path=None keeps the cache in memory only."""
+        self.lock = threading.Lock()
+        self.fileIds = {}
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        if path != None:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            with self.lock, self.connection:
+                self.connection.executescript(fileIdSchema)
+                rows = self.connection.execute(
+                    "SELECT content_hash, file_id FROM file_ids"
+                ).fetchall()
+            self.fileIds = dict(rows)
+
+    def get(self, image: bytes) -> str:
+        key = contentHash(image)
+        with self.lock:
+            fileId = self.fileIds.get(key)
+            if fileId == None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return fileId
+
+    def put(self, image: bytes, fileId: str) -> None:
+        key = contentHash(image)
+        with self.lock:
+            self.fileIds[key] = fileId
+            if self.connection != None:
+                with self.connection:
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO file_ids VALUES (?, ?, ?)",
+                        (key, fileId, time.time()),
+                    )
+
+    def invalidate(self, image: bytes) -> None:
+        key = contentHash(image)
+        with self.lock:
+            self.fileIds.pop(key, None)
+            if self.connection != None:
+                with self.connection:
+                    self.connection.execute(
+                        "DELETE FROM file_ids WHERE content_hash = ?", (key,)
+                    )
+
+    def prune(self, maxAge: float) -> None:
+        """Forget file_ids that were stored more than maxAge seconds ago."""
+        if self.connection == None:
+            return
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM file_ids WHERE uploaded_at < ?", (time.time() - maxAge,)
+            )
+            rows = self.connection.execute(
+                "SELECT content_hash, file_id FROM file_ids"
+            ).fetchall()
+            self.fileIds = dict(rows)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.fileIds),
+            }
@@ -1,44 +1,289 @@
 #!/usr/bin/env python3
+import copy
 import csv
+import json
+import logging
+import os
+import threading
 import pandas as pd
 import prettytable as pt
 
 # import wget
-import math
-from matplotlib import pyplot as plt
 from matplotlib import ticker as pltticker
+import http_client
+import metrics
+from chart_output import newFigure, figureToPng, tightLayout
 
-countryVaccineImage = "country_vaccine.png"
+logger = logging.getLogger(__name__)
+
+dataSetURL = "https://covid.ourworldindata.org/data/"
+covid_data_file = "owid-covid-data.csv"
+
+# Per-location cache of the columns below. It is built from the full CSV once
+# and then only rows newer than each location's last ingested date are
+# appended, either from an updated CSV or from files put in the drop directory.
+datasetCacheDir = "owid-cache"
+datasetManifestFile = "manifest.json"
+datasetCacheVersion = 4
+datasetDropDir = "owid-drop"
+datasetColumns = [
+    "location",
+    "date",
+    "new_vaccinations",
+    "new_vaccinations_smoothed",
+    "people_vaccinated",
+    "people_vaccinated_per_hundred",
+    "people_fully_vaccinated",
+    "people_fully_vaccinated_per_hundred",
+]
+# Only kept in the manifest, so locations can be looked up by ISO code
+datasetIsoColumn = "iso_code"
+datasetCacheLock = threading.Lock()
+loadedManifest = None
+
+
+def downloadDataset() -> None:
+    """Download the OWID CSV to covid_data_file, replacing it in one step."""
+    with open(covid_data_file + ".tmp", "wb") as output:
+        with metrics.timed("upstream", source="owid", call="download"):
+            http_client.download(dataSetURL + covid_data_file, output)
+    os.replace(covid_data_file + ".tmp", covid_data_file)
 
 
 def loadDataset() -> pd.DataFrame:
-    dataSetURL = "https://covid.ourworldindata.org/data/"
-    covid_data_file = "owid-covid-data.csv"
-    # wget.download(dataSetURL+covid_data_file)
-    covid_data = pd.read_csv(covid_data_file)
-    selection = covid_data[
-        [
-            "location",
-            "date",
-            "new_vaccinations",
-            "new_vaccinations_smoothed",
-            "people_vaccinated",
-            "people_vaccinated_per_hundred",
-            "people_fully_vaccinated",
-            "people_fully_vaccinated_per_hundred",
-        ]
-    ]
-    return selection
+    if not os.path.exists(covid_data_file):
+        downloadDataset()
+    columns = datasetColumns + [datasetIsoColumn]
+    return pd.read_csv(covid_data_file, usecols=columns)[columns]
 
 
-def getCountryData(country: str = "Canada") -> pd.DataFrame:
+def getSourceStamp() -> dict:
+    try:
+        stat = os.stat(covid_data_file)
+    except FileNotFoundError:
+        return None
+    return {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def readManifest() -> dict:
+    global loadedManifest
+    manifestPath = os.path.join(datasetCacheDir, datasetManifestFile)
+    try:
+        # Only parse the manifest again when it has been rewritten
+        stamp = os.stat(manifestPath).st_mtime_ns
+        if loadedManifest == None or loadedManifest[0] != stamp:
+            with open(manifestPath, "r") as manifest:
+                loadedManifest = (stamp, json.load(manifest))
+        return loadedManifest[1]
+    except (OSError, ValueError):
+        return None
+
+
+def writeManifest(manifest: dict) -> None:
+    manifestPath = os.path.join(datasetCacheDir, datasetManifestFile)
+    # Write to a temporary file first so readers never see a partial manifest
+    with open(manifestPath + ".tmp", "w") as manifestFile:
+        json.dump(manifest, manifestFile)
+    os.replace(manifestPath + ".tmp", manifestPath)
+
+
+def saveLocation(manifest: dict, location: str, location_df: pd.DataFrame) -> None:
+    entry = manifest["locations"].get(location)
+    if entry == None:
+        entry = {"file": "location_" + str(manifest["nextFile"]) + ".pkl"}
+        manifest["nextFile"] += 1
+        manifest["locations"][location] = entry
+    location_df.to_pickle(os.path.join(datasetCacheDir, entry["file"]))
+    entry["lastDate"] = location_df.index[-1]
+    entry["summary"] = summarizeLocation(location_df)
+
+
+def summarizeLocation(location_df: pd.DataFrame) -> dict:
+    """Map each column to [latest non-NaN value, its date], or None if empty."""
+    summary = {}
+    for column, values in location_df.items():
+        lastIndex = values.last_valid_index()
+        if lastIndex == None:
+            summary[column] = None
+        else:
+            summary[column] = [float(values[lastIndex]), lastIndex]
+    return summary
+
+
+def getLocationSummary(location: str) -> dict:
+    entry = loadDatasetCache()["locations"].get(location)
+    return {} if entry == None else entry["summary"]
+
+
+def buildDatasetCache() -> dict:
+    """Split the whole CSV into one pickle per location and write the manifest."""
     covid_df = loadDataset()
-    country_df = covid_df.loc[covid_df["location"] == country].set_index("date")
-    del country_df["location"]
-    return country_df
+    # Only now, as loadDataset() downloads the CSV if it was missing
+    source = getSourceStamp()
+    os.makedirs(datasetCacheDir, exist_ok=True)
+    manifest = {
+        "version": datasetCacheVersion,
+        "source": source,
+        "nextFile": 0,
+        "locations": {},
+    }
+    for location, location_df in covid_df.groupby("location"):
+        location_df = location_df.set_index("date")
+        isoCode = location_df[datasetIsoColumn].iloc[0]
+        del location_df["location"]
+        del location_df[datasetIsoColumn]
+        saveLocation(manifest, location, location_df)
+        manifest["locations"][location]["iso"] = (
+            isoCode if isinstance(isoCode, str) else None
+        )
+    writeManifest(manifest)
+    return manifest
+
+
+def readNewRows(path: str, lastDates: dict) -> tuple:
+    """
+    Stream the CSV at path and keep only the rows dated after the location's
+    last ingested date, grouped by location. Returns those rows and the ISO
+    code of each location that has any, if the CSV has the ISO column.
+    """
+    newRows = {}
+    isoCodes = {}
+    with open(path, "r", newline="") as csvFile:
+        reader = csv.reader(csvFile)
+        header = next(reader)
+        positions = [header.index(column) for column in datasetColumns]
+        locationPosition = positions[0]
+        datePosition = positions[1]
+        isoPosition = None
+        if datasetIsoColumn in header:
+            isoPosition = header.index(datasetIsoColumn)
+        for row in reader:
+            location = row[locationPosition]
+            lastDate = lastDates.get(location)
+            # ISO dates compare correctly as strings
+            if lastDate != None and row[datePosition] <= lastDate:
+                continue
+            newRows.setdefault(location, []).append(
+                [row[position] for position in positions[1:]]
+            )
+            if isoPosition != None and row[isoPosition] != "":
+                isoCodes[location] = row[isoPosition]
+    return newRows, isoCodes
+
+
+def ingestDataset(path: str, manifest: dict) -> dict:
+    """Append the rows of the CSV at path that are newer than the cache."""
+    lastDates = {
+        location: entry["lastDate"] for location, entry in manifest["locations"].items()
+    }
+    with metrics.timed("upstream", source="owid", call="ingest"):
+        newRows, isoCodes = readNewRows(path, lastDates)
+    for location, rows in newRows.items():
+        new_df = pd.DataFrame(rows, columns=datasetColumns[1:]).set_index("date")
+        new_df = new_df.apply(pd.to_numeric, errors="coerce").astype(float)
+        if location in manifest["locations"]:
+            fileName = manifest["locations"][location]["file"]
+            old_df = pd.read_pickle(os.path.join(datasetCacheDir, fileName))
+            new_df = pd.concat([old_df, new_df])
+        saveLocation(manifest, location, new_df.sort_index())
+        entry = manifest["locations"][location]
+        if entry.get("iso") == None:
+            entry["iso"] = isoCodes.get(location)
+    logger.info(
+        "Ingested %d new rows from %s",
+        sum(len(rows) for rows in newRows.values()),
+        path,
+    )
+    return manifest
+
+
+def hasDatasetColumns(path: str) -> bool:
+    try:
+        with open(path, "r", newline="") as csvFile:
+            header = next(csv.reader(csvFile), [])
+    except (OSError, UnicodeDecodeError, csv.Error):
+        return False
+    return all(column in header for column in datasetColumns)
+
+
+def getDropFiles() -> list:
+    try:
+        return sorted(
+            fileName
+            for fileName in os.listdir(datasetDropDir)
+            if fileName.endswith(".csv")
+        )
+    except FileNotFoundError:
+        return []
+
+
+def ingestDropDirectory(manifest: dict, dropFiles: list) -> None:
+    """
+    Ingest and then move aside the CSVs dropFiles in the drop directory,
+    writing the manifest after each one. Files that can't be ingested are moved
+    to rejected/ so they don't block loading the rest of the data.
+    """
+    for fileName in dropFiles:
+        path = os.path.join(datasetDropDir, fileName)
+        targetDir = os.path.join(datasetDropDir, "processed")
+        if not hasDatasetColumns(path):
+            logger.warning("Rejected %s: it is missing some dataset columns", path)
+            targetDir = os.path.join(datasetDropDir, "rejected")
+        else:
+            try:
+                # The rows are all read before the cache is touched
+                ingestDataset(path, manifest)
+                writeManifest(manifest)
+            except (ValueError, IndexError, UnicodeDecodeError, csv.Error) as error:
+                logger.warning("Rejected %s: %s", path, error)
+                targetDir = os.path.join(datasetDropDir, "rejected")
+        os.makedirs(targetDir, exist_ok=True)
+        os.replace(path, os.path.join(targetDir, fileName))
+
+
+def loadDatasetCache() -> dict:
+    with datasetCacheLock:
+        manifest = readManifest()
+        if manifest == None or manifest.get("version") != datasetCacheVersion:
+            with metrics.timed("upstream", source="owid", call="build"):
+                return buildDatasetCache()
+
+        dropFiles = getDropFiles()
+        source = getSourceStamp()
+        sourceChanged = source != None and source != manifest["source"]
+        if len(dropFiles) == 0 and not sourceChanged:
+            return manifest
+
+        # Callers iterate the manifest they got without the lock, so never
+        # change it; the next readManifest() loads the one written here
+        manifest = copy.deepcopy(manifest)
+        ingestDropDirectory(manifest, dropFiles)
+        if sourceChanged:
+            ingestDataset(covid_data_file, manifest)
+            manifest["source"] = source
+            writeManifest(manifest)
+    return manifest
+
+
+def getCountryData(country: str = "Canada") -> pd.DataFrame:
+    manifest = loadDatasetCache()
+    if country not in manifest["locations"]:
+        return pd.DataFrame(columns=datasetColumns[2:], index=pd.Index([], name="date"))
+    fileName = manifest["locations"][country]["file"]
+    with metrics.timed("upstream", source="owid", call="read"):
+        return pd.read_pickle(os.path.join(datasetCacheDir, fileName))
+
+
+def getLocations() -> dict:
+    """Map every OWID location to its ISO code, or None if it has none."""
+    locations = loadDatasetCache()["locations"]
+    return {location: entry.get("iso") for location, entry in locations.items()}
 
 
 def getCountryString(input_country: str) -> str:
+    # Exact OWID names are passed through; title() would mangle "Cote d'Ivoire"
+    if input_country in loadDatasetCache()["locations"]:
+        return input_country
     country = input_country.title()
     countryRemap = {
         "USA": "United States",
@@ -52,14 +297,20 @@ def getCountryString(input_country: str) -> str:
     return country
 
 
+def getCountryDataVersion(country: str = "Canada") -> tuple:
+    country_df = getCountryData(getCountryString(country))
+    if len(country_df) == 0:
+        return (0, None)
+    return (len(country_df), country_df.index[-1])
+
+
 def getCountrySummary(country: str = "Canada") -> str:
     country = getCountryString(country)
-    country_df = getCountryData(country)
-    currentIndex = country_df.last_valid_index()
-    if currentIndex == None:
+    summary = getLocationSummary(country)
+    dates = [latest[1] for latest in summary.values() if latest != None]
+    if len(dates) == 0:
         raise IndexError()
-    most_recent = country_df.loc[currentIndex]
-    date = most_recent.name
+    date = max(dates)
 
     table = pt.PrettyTable(["Vaccinated", "Count"])
     table.align["Vaccinated"] = "l"
@@ -74,7 +325,7 @@ def getCountrySummary(country: str = "Canada") -> str:
         "people_fully_vaccinated": "Total",
         "people_fully_vaccinated_per_hundred": "Vax %",
     }
-    for cName, cData in most_recent.iteritems():
+    for cName in datasetColumns[2:]:
         if cName.find("smoothed") >= 0:
             continue
         isPercent = cName.find("per_hundred") >= 0
@@ -82,15 +333,14 @@ def getCountrySummary(country: str = "Canada") -> str:
         if isTotal and not second_title_added:
             table.add_row(["2-shot", ""])
             second_title_added = True
-        cName = title_mapping[cName]
-        cName = "- " + cName
-        if isPercent:
-            table.add_row([cName, "{:.2f}".format(cData) + " %"])
+        latest = summary.get(cName)
+        cName = "- " + title_mapping[cName]
+        if latest == None:
+            table.add_row([cName, "-"])
+        elif isPercent:
+            table.add_row([cName, "{:.2f}".format(latest[0]) + " %"])
         else:
-            if math.isnan(cData):
-                table.add_row([cName, "-"])
-            else:
-                table.add_row([cName, format(int(cData), ",d")])
+            table.add_row([cName, format(int(latest[0]), ",d")])
     outputString = (
         "<b>Summary for " + country + "</b>\n<i>(as of " + str(date) + ")</i>\n"
     )
@@ -99,7 +349,8 @@ def getCountrySummary(country: str = "Canada") -> str:
     return outputString
 
 
-def plotCountryVaccinations(country: str = "United States"):
+def getCountryVaccinationChartSpec(country: str = "United States") -> dict:
+    """Select the plotted columns as plain lists for renderCountryVaccinationChart."""
     country_df = getCountryData(getCountryString(country))
     title_mapping = {
         "new_vaccinations_smoothed": "New Vaccinations",
@@ -111,11 +362,23 @@ def plotCountryVaccinations(country: str = "United States"):
         "people_fully_vaccinated_per_hundred",
         "new_vaccinations_smoothed",
     ]
-    current_df = country_df[set].copy()
+    current_df = country_df[set].rename(columns=title_mapping)
+    return {
+        "chart": "country_vaccinations",
+        "title": "Vaccinations for " + country,
+        "dates": list(current_df.index),
+        "columns": {column: list(values) for column, values in current_df.items()},
+    }
+
+
+def renderCountryVaccinationChart(spec: dict) -> bytes:
+    current_df = pd.DataFrame(
+        spec["columns"], index=pd.Index(spec["dates"], name="date")
+    )
 
-    fig, ax = plt.subplots()
-    ax.set_title("Vaccinations for " + country)
-    current_df.rename(columns=title_mapping, inplace=True)
+    fig = newFigure(figsize=(10, 6))
+    ax = fig.subplots()
+    ax.set_title(spec["title"])
     current_df.plot(
         kind="line",
         color="c",
@@ -149,9 +412,12 @@ def plotCountryVaccinations(country: str = "United States"):
         pltticker.FuncFormatter(lambda x, p: format(int(x), ","))
     )
 
-    fig.tight_layout()
-    fig.savefig(countryVaccineImage, format="png", dpi=300, bbox_inches="tight")
-    plt.close()
+    tightLayout(fig)
+    return figureToPng(fig)
+
+
+def plotCountryVaccinations(country: str = "United States") -> bytes:
+    return renderCountryVaccinationChart(getCountryVaccinationChartSpec(country))
 
 
 def main() -> None:
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Shared HTTP client for the upstream APIs (covid19tracker.ca and the OWID
+download).
+
+Connections are kept alive in a pool per host and reused, so repeated requests
+skip the TCP and TLS handshakes, and each host has a cap on the requests in
+flight at once (hostLimits). Connecting and reading have separate timeouts, so
+a hung server fails the request instead of blocking its thread forever.
+Responses are requested with gzip/deflate and decoded as they are read.
+
+Connection errors, timeouts and 429/5xx responses are retried with jittered
+exponential backoff. The time spent connecting and the time spent sending the
+request and reading the response are recorded separately in metrics.
+"""
+import http.client
+import random
+import threading
+import time
+import urllib.parse
+import zlib
+import metrics
+
+connectTimeout = 10.0
+readTimeout = 30.0
+maxRetries = 3
+# Sleep a random time up to backoffBase * 2^attempt seconds, at most backoffMax
+backoffBase = 0.5
+backoffMax = 8.0
+retryStatuses = {429, 500, 502, 503, 504}
+redirectStatuses = {301, 302, 303, 307, 308}
+maxRedirects = 5
+# Requests in flight at once per host; covid19tracker.ca gets a whole batch
+hostLimits = {"api.covid19tracker.ca": 16, "covid.ourworldindata.org": 2}
+defaultHostLimit = 8
+maxIdlePerHost = 16
+readChunkSize = 64 * 1024
+userAgent = "covid-bot (https://github.com/ajaykumarkannan/telegram_bots)"
+
+
+class HTTPError(Exception):
+    def __init__(self, url: str, status: int, reason: str) -> None:
+        super().__init__("HTTP " + str(status) + " " + reason + " for " + url)
+        self.url = url
+        self.status = status
+        self.reason = reason
+
+
+class Response:
+    def __init__(
+        self, url: str, status: int, reason: str, headers, body: bytes
+    ) -> None:
+        self.url = url
+        self.status = status
+        self.reason = reason
+        # An http.client.HTTPMessage, so lookups ignore case
+        self.headers = headers
+        self.body = body
+
+
+class HostPool:
+    """Idle keep-alive connections to one host and its concurrency cap."""
+
+    def __init__(self, scheme: str, host: str, limit: int) -> None:
+        self.scheme = scheme
+        self.host = host
+        self.slots = threading.BoundedSemaphore(limit)
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self) -> tuple:
+        """Return (connection, whether it was used before)."""
+        with self.lock:
+            if len(self.idle) > 0:
+                return self.idle.pop(), True
+        if self.scheme == "https":
+            connection = http.client.HTTPSConnection(self.host, timeout=connectTimeout)
+        else:
+            connection = http.client.HTTPConnection(self.host, timeout=connectTimeout)
+        return connection, False
+
+    def release(self, connection) -> None:
+        with self.lock:
+            if len(self.idle) < maxIdlePerHost:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def close(self) -> None:
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for connection in idle:
+            connection.close()
+
+
+def readBody(response, output=None) -> bytes:
+    """Read and decode the whole body, writing it to output if given."""
+    encoding = (response.getheader("Content-Encoding") or "identity").lower()
+    decoder = None
+    if encoding in ("gzip", "deflate"):
+        # 32 + MAX_WBITS accepts both gzip and zlib headers
+        decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    chunks = []
+    while True:
+        chunk = response.read(readChunkSize)
+        if not chunk:
+            break
+        if decoder != None:
+            chunk = decoder.decompress(chunk)
+        if output == None:
+            chunks.append(chunk)
+        else:
+            output.write(chunk)
+    if decoder != None:
+        chunk = decoder.flush()
+        if output == None:
+            chunks.append(chunk)
+        else:
+            output.write(chunk)
+    return b"".join(chunks)
+
+
+def getBackoff(attempt: int) -> float:
+    # "Full jitter": spreads out the retries of clients that failed together
+    return random.uniform(0, min(backoffMax, backoffBase * 2**attempt))
+
+
+class HTTPClient:
+    def __init__(self, retries: int = maxRetries) -> None:
+        self.retries = retries
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def getPool(self, scheme: str, host: str) -> HostPool:
+        with self.lock:
+            key = (scheme, host)
+            if key not in self.pools:
+                limit = hostLimits.get(host, defaultHostLimit)
+                self.pools[key] = HostPool(scheme, host, limit)
+            return self.pools[key]
+
+    def get(self, url: str, headers: dict = None, output=None) -> Response:
+        """
+        GET url, following redirects, and return the Response. With output (a
+        binary file) the decoded body is written there instead of kept in
+        Response.body. Raises HTTPError for 4xx/5xx statuses, and the network
+        error if every retry fails.
+        """
+        requestHeaders = {"User-Agent": userAgent, "Accept-Encoding": "gzip, deflate"}
+        if headers != None:
+            requestHeaders.update(headers)
+        for _ in range(maxRedirects + 1):
+            response = self.getWithRetries(url, requestHeaders, output)
+            location = response.headers.get("Location")
+            if response.status not in redirectStatuses or location == None:
+                return response
+            url = urllib.parse.urljoin(url, location)
+        raise HTTPError(url, response.status, "Too many redirects")
+
+    def getWithRetries(self, url: str, headers: dict, output) -> Response:
+        parts = urllib.parse.urlsplit(url)
+        pool = self.getPool(parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query != "":
+            path += "?" + parts.query
+        attempt = 0
+        while True:
+            if output != None:
+                # Start the file again if an earlier attempt wrote part of it
+                output.seek(0)
+                output.truncate()
+            try:
+                with pool.slots:
+                    response = self.send(pool, path, headers, output)
+                if response.status >= 400:
+                    raise HTTPError(url, response.status, response.reason)
+                response.url = url
+                return response
+            except (OSError, http.client.HTTPException, HTTPError) as error:
+                retryable = not isinstance(error, HTTPError) or (
+                    error.status in retryStatuses
+                )
+                if not retryable or attempt >= self.retries:
+                    raise
+                metrics.count("http_retries_total", host=pool.host)
+                time.sleep(getBackoff(attempt))
+                attempt += 1
+
+    def send(self, pool: HostPool, path: str, headers: dict, output) -> Response:
+        connection, reused = pool.acquire()
+        try:
+            if connection.sock == None:
+                start = time.perf_counter()
+                connection.connect()
+                metrics.registry.observe(
+                    "http_connect_seconds", time.perf_counter() - start, host=pool.host
+                )
+                connection.sock.settimeout(readTimeout)
+            start = time.perf_counter()
+            try:
+                connection.request("GET", path, headers=headers)
+                response = connection.getresponse()
+            except (
+                http.client.RemoteDisconnected,
+                ConnectionResetError,
+                BrokenPipeError,
+            ):
+                if not reused:
+                    raise
+                # The server closed the idle connection before answering, so
+                # nothing was written to output; retry at once on a new one
+                connection.close()
+                return self.send(pool, path, headers, output)
+            # Errors from here on are retried by getWithRetries, which starts
+            # output again first
+            body = readBody(response, output)
+            metrics.registry.observe(
+                "http_transfer_seconds", time.perf_counter() - start, host=pool.host
+            )
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            pool.release(connection)
+        return Response(None, response.status, response.reason, response.headers, body)
+
+    def close(self) -> None:
+        with self.lock:
+            pools = list(self.pools.values())
+        for pool in pools:
+            pool.close()
+
+
+client = HTTPClient()
+
+
+def get(url: str, headers: dict = None) -> Response:
+    return client.get(url, headers)
+
+
+def download(url: str, output) -> Response:
+    """GET url into the binary file output, decoding it as it arrives."""
+    return client.get(url, output=output)
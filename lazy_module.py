@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+"""
+Stand-in for a module that is only imported when one of its attributes is
+first used.
+
+covid_bot refers to its data and plotting modules through these, so pandas,
+matplotlib and the COVID data clients are not loaded until a command needs
+them (or the warm-up after start-up loads them in the background).
+"""
+import importlib
+
+
+class LazyModule:
+    def __init__(self, name: str) -> None:
+        self.lazyName = name
+        self.lazyModule = None
+
+    def load(self):
+        # import_module takes the import lock, so racing threads get one module
+        if self.lazyModule == None:
+            self.lazyModule = importlib.import_module(self.lazyName)
+        return self.lazyModule
+
+    def isLoaded(self) -> bool:
+        return self.lazyModule != None
+
+    def __getattr__(self, name: str):
+        # Only called for attributes the LazyModule itself doesn't have
+        return getattr(self.load(), name)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+One index of every location the bot can report on.
+
+It is built once from the CovId19Data country and region lists, the OWID
+locations and the Canadian province table, and maps each name onto the names
+every data source expects. Names are compared after case folding and removing
+accents and punctuation, so "Côte d'Ivoire" and "cote divoire" are the same
+key, while hyphens and slashes separate words, so "Timor-Leste" is "timor
+leste". Aliases and ISO codes point at the same entries, and a name matching
+none of them falls back to the closest key so small typos still resolve.
+Unknown names are rejected without fetching anything.
+"""
+
+import difflib
+import re
+import threading
+import unicodedata
+
+# Lowest difflib ratio accepted for a typo; "untied states" is about 0.92
+fuzzyCutoff = 0.8
+# Shorter names are too close to too many keys to guess which one was meant
+fuzzyMinLength = 4
+fuzzyCacheSize = 4096
+
+# Normalized alias: normalized key of the country it stands for. The
+# CovId19Data names that differ from OWID's are mapped the same way.
+countryAliases = {
+    "us": "united states",
+    "usa": "united states",
+    "america": "united states",
+    "uk": "united kingdom",
+    "britain": "united kingdom",
+    "great britain": "united kingdom",
+    "uae": "united arab emirates",
+    "korea": "south korea",
+    "korea south": "south korea",
+    "drc": "democratic republic of congo",
+    "congo kinshasa": "democratic republic of congo",
+    "congo brazzaville": "congo",
+    "burma": "myanmar",
+    "cabo verde": "cape verde",
+    "czech republic": "czechia",
+    "east timor": "timor",
+    "timor leste": "timor",
+    "holy see": "vatican",
+    "ivory coast": "cote divoire",
+    "macedonia": "north macedonia",
+    "micronesia": "micronesia country",
+    "swaziland": "eswatini",
+    "west bank and gaza": "palestine",
+}
+regionAliases = {
+    "newfoundland": "newfoundland and labrador",
+    "pei": "prince edward island",
+}
+
+
+class LocationNotFound(Exception):
+    pass
+
+
+def normalizeName(name: str) -> str:
+    name = unicodedata.normalize("NFKD", name.casefold())
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    name = re.sub(r"[-/_]", " ", name)
+    name = re.sub(r"[^\w\s]", "", name)
+    return " ".join(name.split())
+
+
+def getClosestKey(key: str, keys: list) -> str:
+    """Return the one key closest to key, or None if none or several are."""
+    if len(key) < fuzzyMinLength:
+        return None
+    matches = difflib.get_close_matches(key, keys, n=2, cutoff=fuzzyCutoff)
+    if len(matches) == 0:
+        return None
+    if len(matches) == 2:
+        # Scored the way get_close_matches does, with the candidate first
+        scores = [
+            difflib.SequenceMatcher(None, match, key).ratio() for match in matches
+        ]
+        if scores[0] == scores[1]:
+            return None
+    return matches[0]
+
+
+class Location:
+    """
+    name is the one to show and store. casesName is the CovId19Data name,
+    owidName the OWID location and provinceCode the covid19tracker.ca code;
+    each is None when that source has no data for the location.
+    """
+
+    def __init__(self, name: str, kind: str) -> None:
+        self.name = name
+        self.kind = kind
+        self.casesName = None
+        self.owidName = None
+        self.provinceCode = None
+
+    def __repr__(self) -> str:
+        return "Location(" + repr(self.name) + ", " + repr(self.kind) + ")"
+
+
+class LocationIndex:
+    def __init__(
+        self,
+        countries: list,
+        regions: list,
+        owidLocations: dict,
+        provinces: dict,
+    ) -> None:
+        """
+        countries and regions are the CovId19Data names, owidLocations maps
+        each OWID location to its ISO code (or None) and provinces maps the
+        province names and codes to their covid19tracker.ca codes.
+        """
+        self.countries = {}
+        self.regions = {}
+        self.countryAliases = dict(countryAliases)
+        self.regionAliases = dict(regionAliases)
+        self.fuzzyMatches = {}
+        self.lock = threading.Lock()
+
+        for owidName, isoCode in owidLocations.items():
+            key = normalizeName(owidName)
+            self.countries.setdefault(key, Location(owidName, "country"))
+            self.countries[key].owidName = owidName
+            if isoCode != None and not isoCode.startswith("OWID_"):
+                self.countryAliases.setdefault(isoCode.lower(), key)
+        for casesName in countries:
+            key = normalizeName(casesName)
+            key = self.countryAliases.get(key, key)
+            self.countries.setdefault(key, Location(casesName, "country"))
+            self.countries[key].casesName = casesName
+
+        for casesName in regions:
+            key = normalizeName(casesName)
+            self.regions.setdefault(key, Location(casesName, "region"))
+            self.regions[key].casesName = casesName
+        # The full name of a province is the longest one with its code
+        provinceNames = {}
+        for name, code in provinces.items():
+            if len(name) > len(provinceNames.get(code, "")):
+                provinceNames[code] = name
+        for name, code in provinces.items():
+            key = normalizeName(provinceNames[code])
+            if name != provinceNames[code]:
+                self.regionAliases.setdefault(normalizeName(name), key)
+                continue
+            location = self.regions.setdefault(key, Location(name, "region"))
+            location.name = name
+            location.provinceCode = code
+
+        # Candidates for typo matching: only the names themselves, as aliases
+        # and ISO codes are short enough to match almost anything
+        self.countryKeys = list(self.countries)
+        self.regionKeys = list(self.regions)
+
+    def __len__(self) -> int:
+        return len(self.countries) + len(self.regions)
+
+    def find(self, kind: str, name: str) -> Location:
+        if kind == "country":
+            locations, aliases, keys = (
+                self.countries,
+                self.countryAliases,
+                self.countryKeys,
+            )
+        else:
+            locations, aliases, keys = self.regions, self.regionAliases, self.regionKeys
+        key = normalizeName(name)
+        key = aliases.get(key, key)
+        if key in locations:
+            return locations[key]
+
+        with self.lock:
+            if (kind, key) in self.fuzzyMatches:
+                return self.fuzzyMatches[(kind, key)]
+        match = getClosestKey(key, keys)
+        location = None if match == None else locations[match]
+        with self.lock:
+            if len(self.fuzzyMatches) >= fuzzyCacheSize:
+                self.fuzzyMatches.clear()
+            self.fuzzyMatches[(kind, key)] = location
+        return location
+
+    def getCountry(self, name: str) -> Location:
+        """Return the country best matching name, or None if there is none."""
+        return self.find("country", name)
+
+    def getRegion(self, name: str) -> Location:
+        """Return the region best matching name, or None if there is none."""
+        return self.find("region", name)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+In-process latency and error metrics, exported in the Prometheus text format.
+
+Code paths are wrapped in timed(stage, **labels), which adds the duration to a
+histogram and counts any exception raised inside as an error; count() bumps a
+plain counter. Values kept elsewhere, like the caches' hit and miss counts,
+are read at export time from the collectors added with addCollector().
+
+A sampled fraction of the calls wrapped in profiled() run under cProfile and
+their stats are written to profileDir for later inspection with pstats.
+"""
+import bisect
+import contextlib
+import cProfile
+import http.server
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+metricPrefix = "covid_bot_"
+latencyBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Set profileSampleRate above 0 (e.g. 0.01) to profile that share of calls
+profileSampleRate = 0.0
+profileDir = "profiles"
+# cProfile can't run two profilers at once, so only one sample runs at a time
+profileLock = threading.Lock()
+
+
+def formatLabels(labels: tuple) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = [
+        name
+        + '="'
+        + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for name, value in labels
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+class Histogram:
+    def __init__(self) -> None:
+        # One count per bucket plus the +Inf bucket, not cumulative
+        self.counts = [0] * (len(latencyBuckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(latencyBuckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.histograms = {}
+        self.counters = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def count(self, name: str, amount: int = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def timed(self, stage: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count("errors_total", stage=stage, **labels)
+            raise
+        finally:
+            self.observe(
+                "stage_seconds", time.perf_counter() - start, stage=stage, **labels
+            )
+
+    def addCollector(self, collect) -> None:
+        """collect() returns a list of (name, labels dict, value) gauges."""
+        self.collectors.append(collect)
+
+    def collect(self) -> list:
+        gauges = []
+        for collect in self.collectors:
+            try:
+                gauges.extend(collect())
+            except Exception:
+                logger.exception("Metrics collector failed")
+        return gauges
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        with self.lock:
+            histograms = {
+                key: (list(h.counts), h.sum, h.count)
+                for key, h in self.histograms.items()
+            }
+            counters = dict(self.counters)
+        lines = []
+        typed = set()
+        for (name, labels), (counts, total, number) in sorted(histograms.items()):
+            fullName = metricPrefix + name
+            if fullName not in typed:
+                lines.append("# TYPE " + fullName + " histogram")
+                typed.add(fullName)
+            cumulative = 0
+            for bound, bucketCount in zip(latencyBuckets + ("+Inf",), counts):
+                cumulative += bucketCount
+                bucketLabels = formatLabels(labels + (("le", bound),))
+                lines.append(
+                    fullName + "_bucket" + bucketLabels + " " + str(cumulative)
+                )
+            lines.append(fullName + "_sum" + formatLabels(labels) + " " + repr(total))
+            lines.append(fullName + "_count" + formatLabels(labels) + " " + str(number))
+        for (name, labels), value in sorted(counters.items()):
+            fullName = metricPrefix + name
+            if fullName not in typed:
+                lines.append("# TYPE " + fullName + " counter")
+                typed.add(fullName)
+            lines.append(fullName + formatLabels(labels) + " " + str(value))
+        for name, labels, value in sorted(self.collect(), key=lambda g: g[0]):
+            fullName = metricPrefix + name
+            if fullName not in typed:
+                lines.append("# TYPE " + fullName + " gauge")
+                typed.add(fullName)
+            labels = tuple(sorted(labels.items()))
+            lines.append(fullName + formatLabels(labels) + " " + str(value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """A short per-stage overview that fits in a chat message."""
+        with self.lock:
+            stages = {}
+            for (name, labels), histogram in self.histograms.items():
+                stage = dict(labels).get("stage", name)
+                calls, total = stages.get(stage, (0, 0.0))
+                stages[stage] = (calls + histogram.count, total + histogram.sum)
+            errors = {}
+            for (name, labels), value in self.counters.items():
+                if name == "errors_total":
+                    stage = dict(labels).get("stage", "")
+                    errors[stage] = errors.get(stage, 0) + value
+        lines = []
+        for stage, (calls, total) in sorted(stages.items()):
+            lines.append(
+                "{}: {} calls, {:.0f} ms avg, {} errors".format(
+                    stage, calls, 1000 * total / calls, errors.get(stage, 0)
+                )
+            )
+        for name, labels, value in self.collect():
+            labels = formatLabels(tuple(sorted(labels.items())))
+            lines.append(name + labels + ": " + str(value))
+        return "\n".join(lines)
+
+
+registry = Registry()
+
+
+def timed(stage: str, **labels):
+    return registry.timed(stage, **labels)
+
+
+def count(name: str, amount: int = 1, **labels) -> None:
+    registry.count(name, amount, **labels)
+
+
+@contextlib.contextmanager
+def profiled(name: str):
+    """Run the block under cProfile for a profileSampleRate share of calls."""
+    if profileSampleRate <= 0.0 or random.random() >= profileSampleRate:
+        yield
+        return
+    if not profileLock.acquire(blocking=False):
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profileLock.release()
+        os.makedirs(profileDir, exist_ok=True)
+        path = os.path.join(
+            profileDir, "{}-{}.prof".format(name, time.strftime("%Y%m%d-%H%M%S"))
+        )
+        profiler.dump_stats(path)
+        logger.info("Wrote profile %s", path)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def startHttpServer(port: int, host: str = "127.0.0.1"):
+    """Serve /metrics for Prometheus from a daemon thread."""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="metrics_http", daemon=True
+    ).start()
+    return server
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Long lists split into pages that each fit in one Telegram message.
+
+The items are loaded once, on first use, and kept in memory along with their
+pages. Lists filtered by a prefix are paged on demand and the most recent
+filters are kept too, so paging through a list never reloads it.
+"""
+import collections
+import threading
+from location_index import normalizeName
+
+telegramMessageLimit = 4096
+
+
+def paginate(lines: list, limit: int = telegramMessageLimit) -> list:
+    """Join lines into pages of at most limit characters, one line per row."""
+    pages = []
+    page = []
+    pageLength = 0
+    for line in lines:
+        line = line[:limit]
+        # Every line but the first on a page adds a newline
+        if len(page) > 0 and pageLength + 1 + len(line) > limit:
+            pages.append("\n".join(page))
+            page = []
+            pageLength = 0
+        pageLength += len(line) + (1 if len(page) > 0 else 0)
+        page.append(line)
+    if len(page) > 0:
+        pages.append("\n".join(page))
+    return pages
+
+
+class PaginatedList:
+    def __init__(
+        self, loadItems, pageLimit: int = telegramMessageLimit, maxFilters: int = 64
+    ) -> None:
+        """loadItems() returns the items; it is only called once."""
+        self.loadItems = loadItems
+        self.pageLimit = pageLimit
+        self.maxFilters = maxFilters
+        self.items = None
+        self.keys = None
+        self.pages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def getPages(self, prefix: str = None) -> list:
+        """
+        Return the pages of the items starting with prefix (all of them for
+        None), compared the way location names are. Empty if none match.
+        """
+        key = "" if prefix == None else normalizeName(prefix)
+        with self.lock:
+            if self.items == None:
+                self.items = sorted(set(self.loadItems()), key=normalizeName)
+                self.keys = [normalizeName(item) for item in self.items]
+            if key in self.pages:
+                self.pages.move_to_end(key)
+                return self.pages[key]
+            pages = paginate(
+                [
+                    item
+                    for item, itemKey in zip(self.items, self.keys)
+                    if itemKey.startswith(key)
+                ],
+                self.pageLimit,
+            )
+            self.pages[key] = pages
+            # The full list (key "") is never evicted
+            while len(self.pages) > self.maxFilters:
+                oldest = next(iter(self.pages))
+                if oldest == "":
+                    self.pages.move_to_end(oldest)
+                    oldest = next(iter(self.pages))
+                del self.pages[oldest]
+            return pages
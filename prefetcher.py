@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Background warm-up of the most requested locations.
+
+The bot records every (country, state) it serves. A daemon thread then
+re-runs warm(country, state) for the top N locations every interval seconds,
+and at each configured publish time (HH:MM UTC) it first calls refresh() so
+the upstream caches are dropped and the new data is fetched and rendered
+before anyone asks for it.
+"""
+import collections
+import datetime
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    def __init__(
+        self,
+        warm,
+        refresh=None,
+        topN: int = 10,
+        interval: float = 600.0,
+        publishTimes: list = (),
+    ) -> None:
+        self.warm = warm
+        self.refresh = refresh
+        self.topN = topN
+        self.interval = interval
+        self.publishTimes = [
+            datetime.datetime.strptime(publishTime, "%H:%M").time()
+            for publishTime in publishTimes
+        ]
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="prefetcher", daemon=True)
+
+    def record(self, country: str, state: str) -> None:
+        key = (
+            None if country == None else country.lower(),
+            None if state == None else state.lower(),
+        )
+        with self.lock:
+            self.counts[key] += 1
+
+    def topLocations(self) -> list:
+        with self.lock:
+            return [location for location, _ in self.counts.most_common(self.topN)]
+
+    def getNextPublish(self, now: datetime.datetime) -> datetime.datetime:
+        upcoming = []
+        for publishTime in self.publishTimes:
+            publish = datetime.datetime.combine(
+                now.date(), publishTime, tzinfo=datetime.timezone.utc
+            )
+            if publish <= now:
+                publish += datetime.timedelta(days=1)
+            upcoming.append(publish)
+        return min(upcoming) if upcoming else None
+
+    def warmAll(self) -> None:
+        start = time.perf_counter()
+        locations = self.topLocations()
+        for country, state in locations:
+            if self.stopped.is_set():
+                return
+            try:
+                self.warm(country, state)
+            except Exception:
+                logger.exception("Prefetch failed for %s %s", country, state)
+        logger.info(
+            "Prefetched %d locations in %.1fs",
+            len(locations),
+            time.perf_counter() - start,
+        )
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            now = datetime.datetime.now(datetime.timezone.utc)
+            nextPublish = self.getNextPublish(now)
+            delay = self.interval
+            isPublish = False
+            if nextPublish != None and (nextPublish - now).total_seconds() <= delay:
+                delay = (nextPublish - now).total_seconds()
+                isPublish = True
+            if self.stopped.wait(delay):
+                return
+            if isPublish and self.refresh != None:
+                self.refresh()
+            self.warmAll()
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Chart rendering service backed by a pool of worker processes.
+
+Callers submit chart specs (plain series data plus a "chart" type, as built
+by the get*ChartSpec functions) and get PNG bytes back. Workers import
+matplotlib and the plotting modules once at start-up, so each job only pays
+for drawing. A job that exceeds the timeout raises multiprocessing.TimeoutError
+and the pool is replaced so the stuck worker doesn't hold a slot. Jobs still
+waiting on the replaced pool fail straight away rather than at their timeout.
+"""
+import importlib
+import logging
+import multiprocessing
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# How often a waiting caller checks whether its pool was replaced
+poolCheckInterval = 0.5
+
+chartRenderers = {
+    "cases": ("covid_stats_plotter", "renderCasesChart"),
+    "vaccinations": ("vaccinations", "renderVaccinationChart"),
+    "country_vaccinations": ("global_vaccinations", "renderCountryVaccinationChart"),
+    "province_grid": ("vaccinations", "renderProvinceGridChart"),
+}
+
+
+def initWorker(renderProfile: str) -> None:
+    import matplotlib
+    import chart_output
+
+    matplotlib.use("Agg")
+    if renderProfile != None:
+        chart_output.setRenderProfile(renderProfile)
+    for moduleName, _ in chartRenderers.values():
+        importlib.import_module(moduleName)
+
+
+def renderChart(spec: dict) -> bytes:
+    moduleName, functionName = chartRenderers[spec["chart"]]
+    module = importlib.import_module(moduleName)
+    return getattr(module, functionName)(spec)
+
+
+class RenderService:
+    def __init__(
+        self, workers: int = 0, timeout: float = 60.0, renderProfile: str = None
+    ) -> None:
+        """
+        workers=0 renders in the calling thread, which is handy for debugging.
+        renderProfile=None keeps chart_output's current profile.
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.renderProfile = renderProfile
+        self.pool = None
+        self.poolLock = threading.Lock()
+        if self.workers > 0:
+            self.pool = self.newPool()
+
+    def newPool(self):
+        # Workers may be spawned rather than forked, so pass the profile on
+        return multiprocessing.Pool(
+            self.workers, initializer=initWorker, initargs=(self.renderProfile,)
+        )
+
+    def renderAll(self, specs: list) -> list:
+        """Render all specs in parallel and return their PNG bytes in order."""
+        # Every job of a call goes to the same pool, even if it is replaced
+        pool = self.pool
+        if pool == None:
+            if self.renderProfile != None:
+                import chart_output
+
+                chart_output.setRenderProfile(self.renderProfile)
+            return [renderChart(spec) for spec in specs]
+
+        jobs = [pool.apply_async(renderChart, (spec,)) for spec in specs]
+        try:
+            return [self.waitForJob(pool, job) for job in jobs]
+        except multiprocessing.TimeoutError:
+            self.restartPool(pool)
+            raise
+
+    def waitForJob(self, pool, job) -> bytes:
+        deadline = time.monotonic() + self.timeout
+        while not job.ready():
+            # A terminated pool never finishes its jobs, so don't wait them out
+            if self.pool is not pool:
+                raise multiprocessing.TimeoutError("The render pool was restarted")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise multiprocessing.TimeoutError()
+            job.wait(min(remaining, poolCheckInterval))
+        return job.get()
+
+    def restartPool(self, pool) -> None:
+        """Replace pool, unless another caller has replaced it already."""
+        with self.poolLock:
+            if self.pool is not pool:
+                return
+            logger.warning("Chart rendering timed out, restarting the render pool")
+            pool.terminate()
+            self.pool = self.newPool()
+
+    def close(self) -> None:
+        with self.poolLock:
+            pool = self.pool
+            self.pool = None
+        if pool != None:
+            pool.close()
+            pool.join()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Compute each scheduled (country, state) report once per time bucket.
+
+Scheduled jobs that fire for the same location within the same bucket share
+one Report: the first job builds it while the others wait. Sends are
+serialized until the first upload finishes, so its Telegram file_ids can be
+reused by every later send.
+"""
+import threading
+import time
+
+
+class Report:
+    def __init__(self, images: list, summary: str) -> None:
+        self.images = images
+        self.summary = summary
+        self.uploaded = False
+        self.uploadLock = threading.Lock()
+
+
+class PendingReport:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.report = None
+        self.error = None
+
+
+class ReportFanout:
+    def __init__(self, buildReport, bucketSeconds: int = 300) -> None:
+        """buildReport(country, state) must return a Report."""
+        self.buildReport = buildReport
+        self.bucketSeconds = bucketSeconds
+        self.reports = {}
+        self.lock = threading.Lock()
+
+    def getReport(self, country: str, state: str) -> Report:
+        bucket = int(time.time() // self.bucketSeconds)
+        key = (country, state, bucket)
+        with self.lock:
+            # Drop the reports from earlier buckets
+            for oldKey in [k for k in self.reports if k[2] < bucket]:
+                del self.reports[oldKey]
+            pending = self.reports.get(key)
+            isBuilder = pending == None
+            if isBuilder:
+                pending = PendingReport()
+                self.reports[key] = pending
+
+        if not isBuilder:
+            pending.done.wait()
+            if pending.error != None:
+                raise pending.error
+            return pending.report
+
+        try:
+            pending.report = self.buildReport(country, state)
+        except Exception as error:
+            pending.error = error
+            with self.lock:
+                self.reports.pop(key, None)
+            raise
+        finally:
+            pending.done.set()
+        return pending.report
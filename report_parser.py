@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Streaming parser for covid19tracker.ca reports.
+
+A report is {"province": ..., "last_updated": ..., "data": [record, ...]}
+with one flat record of about two dozen fields per day, and the bot only uses
+a handful of them. ReportParser is written to like a file as the response
+arrives. Each time a chunk completes some records, the wanted fields are
+pulled out of their text with one regex scan per field and appended to typed
+arrays, and the text is dropped, so neither the body nor a list of record
+dicts is ever held in memory. Only the last record is decoded whole, for the
+summaries. A run of records where a field is missing or repeated is decoded
+with json instead, so the arrays always stay aligned with the dates.
+
+parseLatestRecord() is the fast path when only the last record is needed: it
+finds the record at the end of the body and decodes nothing else.
+"""
+import array
+import json
+import re
+import numpy as np
+
+# The plotted fields; the summaries read the last record instead
+reportFields = [
+    "total_vaccinations",
+    "total_vaccinated",
+    "total_boosters_1",
+    "change_vaccinations",
+    "change_vaccinated",
+]
+datePattern = re.compile(rb'"date":\s*"([^"]*)"')
+whitespace = b" \t\r\n"
+
+
+def getFieldPattern(field: str):
+    return re.compile(b'"' + field.encode() + rb'":\s*(null|[-+.0-9eE]+)')
+
+
+def toFloats(values: list) -> list:
+    return [np.nan if value == b"null" else float(value) for value in values]
+
+
+class ProjectedReport:
+    """
+    dates is a datetime64[D] array and columns maps each projected field to a
+    float array, with NaN where the report has null. latest is the last record
+    with all of its fields.
+    """
+
+    def __init__(self, dates, columns: dict, latest: dict) -> None:
+        self.dates = dates
+        self.columns = columns
+        self.latest = latest
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+
+class ReportParser:
+    """
+    File-like sink for http_client: write() the body in chunks of any size,
+    then call result(). seek(0) and truncate() start again, as the client
+    does before retrying a request.
+    """
+
+    def __init__(self, fields: list = None) -> None:
+        self.fields = reportFields if fields == None else fields
+        self.patterns = {field: getFieldPattern(field) for field in self.fields}
+        self.truncate()
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return 0
+
+    def truncate(self, size: int = None) -> int:
+        # The text not parsed yet, which starts after the last complete record
+        self.buffer = b""
+        self.inData = False
+        self.dates = []
+        self.columns = {field: array.array("d") for field in self.fields}
+        self.lastRecord = None
+        return 0
+
+    def write(self, chunk: bytes) -> int:
+        self.buffer += chunk
+        # A record's "}" is followed by the "," or "]" of the data array
+        end = max(self.buffer.rfind(b"},"), self.buffer.rfind(b"}]"))
+        if end >= 0:
+            self.addRecords(self.buffer[: end + 1])
+            self.buffer = self.buffer[end + 1 :]
+        return len(chunk)
+
+    def result(self) -> ProjectedReport:
+        end = self.buffer.rfind(b"]")
+        end = self.buffer.rfind(b"}", 0, end)
+        if end >= 0:
+            self.addRecords(self.buffer[: end + 1])
+        self.buffer = b""
+        if self.lastRecord == None:
+            raise ValueError("covid19tracker report has no data")
+        return ProjectedReport(
+            np.array(self.dates).astype("datetime64[D]"),
+            {
+                field: np.frombuffer(values, dtype=float)
+                for field, values in self.columns.items()
+            },
+            json.loads(self.lastRecord),
+        )
+
+    def addRecords(self, text: bytes) -> None:
+        """Project the complete records in text, which ends with a record."""
+        if not self.inData:
+            start = text.find(b'"data"')
+            if start >= 0:
+                start = text.find(b"[", start)
+            if start < 0:
+                raise ValueError("covid19tracker report has no data array")
+            text = text[start + 1 :]
+            self.inData = True
+        dates = datePattern.findall(text)
+        columns = {
+            field: pattern.findall(text) for field, pattern in self.patterns.items()
+        }
+        if any(len(values) != len(dates) for values in columns.values()):
+            self.addDecodedRecords(text)
+        else:
+            self.dates.extend(dates)
+            for field, values in columns.items():
+                self.columns[field].extend(toFloats(values))
+        # Records are flat, so the last one starts at the last "{"
+        self.lastRecord = text[text.rfind(b"{") :]
+
+    def addDecodedRecords(self, text: bytes) -> None:
+        records = json.loads(b"[" + text.strip(whitespace + b",") + b"]")
+        for record in records:
+            self.dates.append(record["date"].encode())
+            for field, values in self.columns.items():
+                value = record.get(field)
+                values.append(np.nan if value == None else float(value))
+
+
+def parseReport(body: bytes, fields: list = None) -> ProjectedReport:
+    parser = ReportParser(fields)
+    parser.write(body)
+    return parser.result()
+
+
+def parseLatestRecord(body: bytes) -> dict:
+    """
+    Return the last record of the report in body without decoding the others.
+    Records are flat objects, so the last one runs from the last "{" before
+    the "}" that ends it.
+    """
+    end = body.rfind(b"]")
+    end = body.rfind(b"}", 0, end) + 1
+    start = body.rfind(b"{", 0, end)
+    if start > 0:
+        try:
+            record = json.loads(body[start:end])
+            if isinstance(record, dict) and "date" in record:
+                return record
+        except ValueError:
+            pass
+    # Not the expected layout, so parse it properly
+    return parseReport(body, []).latest
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Shared in-process cache for upstream HTTP responses.
+
+Entries are keyed by URL and kept for a configurable TTL. Expired entries are
+revalidated with ETag / If-Modified-Since, the least recently used entries are
+evicted once the cache is full, and concurrent callers asking for the same URL
+wait on a single in-flight fetch instead of each hitting the network.
+Requests go through the shared http_client, so they reuse its connections.
+With parseStream the body is parsed as it arrives instead of being kept.
+"""
+import collections
+import threading
+import time
+import urllib.parse
+import http_client
+import metrics
+
+
+class CacheEntry:
+    def __init__(self, body: bytes, value, etag: str, lastModified: str) -> None:
+        self.body = body
+        self.value = value
+        self.etag = etag
+        self.lastModified = lastModified
+        self.fetchedAt = time.monotonic()
+
+
+class InFlight:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.entry = None
+        self.error = None
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        ttl: float = 300.0,
+        maxEntries: int = 64,
+        parse=None,
+        client=None,
+        parseStream=None,
+    ) -> None:
+        """
+        parse(body) turns the body into the cached value. parseStream() instead
+        returns a writable object that is given the body as it is read, and
+        whose result() is the cached value.
+        """
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.parse = parse
+        self.parseStream = parseStream
+        self.client = client
+        if self.client == None:
+            self.client = http_client.client
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.entries = collections.OrderedDict()
+        self.inFlight = {}
+        self.lock = threading.Lock()
+
+    def get(self, url: str):
+        """Return the (parsed) response for url, fetching it if needed."""
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry != None and time.monotonic() - entry.fetchedAt < self.ttl:
+                self.entries.move_to_end(url)
+                self.hits += 1
+                return entry.value
+            self.misses += 1
+            flight = self.inFlight.get(url)
+            isLeader = flight == None
+            if isLeader:
+                flight = InFlight()
+                self.inFlight[url] = flight
+
+        if not isLeader:
+            flight.done.wait()
+            if flight.error != None:
+                raise flight.error
+            return flight.entry.value
+
+        try:
+            flight.entry = self.fetch(url, entry)
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                if flight.entry != None:
+                    self.entries[url] = flight.entry
+                    self.entries.move_to_end(url)
+                    while len(self.entries) > self.maxEntries:
+                        self.entries.popitem(last=False)
+                del self.inFlight[url]
+            flight.done.set()
+        return flight.entry.value
+
+    def peek(self, url: str):
+        """Return the cached value for url if it is still fresh, else None."""
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry != None and time.monotonic() - entry.fetchedAt < self.ttl:
+                return entry.value
+        return None
+
+    def fetch(self, url: str, stale: CacheEntry = None) -> CacheEntry:
+        headers = {}
+        if stale != None:
+            if stale.etag != None:
+                headers["If-None-Match"] = stale.etag
+            if stale.lastModified != None:
+                headers["If-Modified-Since"] = stale.lastModified
+        output = None if self.parseStream == None else self.parseStream()
+        with metrics.timed("upstream", source=urllib.parse.urlsplit(url).netloc):
+            response = self.client.get(url, headers, output)
+        if response.status == 304 and stale != None:
+            self.revalidations += 1
+            stale.fetchedAt = time.monotonic()
+            return stale
+        if response.status != 200:
+            raise http_client.HTTPError(url, response.status, "Unexpected status")
+        body = response.body
+        if output != None:
+            body = None
+            value = output.result()
+        elif self.parse != None:
+            value = self.parse(body)
+        else:
+            value = body
+        etag = response.headers.get("ETag")
+        lastModified = response.headers.get("Last-Modified")
+        return CacheEntry(body, value, etag, lastModified)
+
+    def invalidate(self, url: str = None) -> None:
+        with self.lock:
+            if url == None:
+                self.entries.clear()
+            else:
+                self.entries.pop(url, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "entries": len(self.entries),
+            }
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+SQLite-backed store for the scheduled /daily and /repeat subscriptions.
+
+Subscriptions are indexed by chat_id (for /jobs and /delete) and by their next
+fire time, so a single periodic job can pick up whatever is due with one index
+range query. Because the schedule lives in the database it survives restarts.
+"""
+import sqlite3
+import threading
+
+subscriptionSchema = """
+CREATE TABLE IF NOT EXISTS subscriptions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    time_of_day TEXT,
+    interval INTEGER,
+    country TEXT,
+    state TEXT,
+    next_fire REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS subscriptions_by_chat ON subscriptions (chat_id, id);
+CREATE INDEX IF NOT EXISTS subscriptions_by_next_fire ON subscriptions (next_fire);
+"""
+
+subscriptionColumns = (
+    "id, chat_id, kind, time_of_day, interval, country, state, next_fire"
+)
+
+
+class Subscription:
+    def __init__(
+        self, id, chat_id, kind, time_of_day, interval, country, state, next_fire
+    ) -> None:
+        self.id = id
+        self.chat_id = chat_id
+        self.kind = kind
+        self.time_of_day = time_of_day
+        self.interval = interval
+        self.country = country
+        self.state = state
+        self.next_fire = next_fire
+
+    def __str__(self) -> str:
+        if self.kind == "daily":
+            schedule = "daily at " + self.time_of_day + " UTC"
+        else:
+            schedule = "every " + str(self.interval // 3600) + " hour(s)"
+        locations = [name for name in (self.country, self.state) if name != None]
+        return schedule + " - " + " ".join(locations)
+
+
+class SubscriptionStore:
+    def __init__(self, path: str = "subscriptions.db") -> None:
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(subscriptionSchema)
+
+    def add(
+        self,
+        chat_id: int,
+        kind: str,
+        country: str,
+        state: str,
+        next_fire: float,
+        time_of_day: str = None,
+        interval: int = None,
+    ) -> Subscription:
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO subscriptions"
+                " (chat_id, kind, time_of_day, interval, country, state, next_fire)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (chat_id, kind, time_of_day, interval, country, state, next_fire),
+            )
+        return Subscription(
+            cursor.lastrowid,
+            chat_id,
+            kind,
+            time_of_day,
+            interval,
+            country,
+            state,
+            next_fire,
+        )
+
+    def listForChat(self, chat_id: int) -> list:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT " + subscriptionColumns + " FROM subscriptions"
+                " WHERE chat_id = ? ORDER BY id",
+                (chat_id,),
+            ).fetchall()
+        return [Subscription(*row) for row in rows]
+
+    def getDue(self, now: float) -> list:
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT " + subscriptionColumns + " FROM subscriptions"
+                " WHERE next_fire <= ? ORDER BY next_fire",
+                (now,),
+            ).fetchall()
+        return [Subscription(*row) for row in rows]
+
+    def setNextFires(self, subscriptions: list) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE subscriptions SET next_fire = ? WHERE id = ?",
+                [
+                    (subscription.next_fire, subscription.id)
+                    for subscription in subscriptions
+                ],
+            )
+
+    def count(self) -> int:
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM subscriptions"
+            ).fetchone()[0]
+
+    def remove(self, id: int) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM subscriptions WHERE id = ?", (id,))
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
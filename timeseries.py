@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Vectorized helpers for turning API histories into NumPy series.
+
+The rolling mean matches the ring buffer the plotters used before: the window
+starts out filled with zeros, so the first window - 1 points are averaged over
+the full window size.
+"""
+import numpy as np
+import pandas as pd
+
+
+def historyToArrays(history: dict, fields: list) -> tuple:
+    """Split a {date: {field: value}} history into a date list and NumPy arrays."""
+    dates = list(history)
+    records = history.values()
+    columns = {
+        field: np.fromiter(
+            (record[field] for record in records), dtype=float, count=len(dates)
+        )
+        for field in fields
+    }
+    return dates, columns
+
+
+def parseDates(dates) -> pd.DatetimeIndex:
+    return pd.to_datetime(pd.Index(dates))
+
+
+def dailyChange(totals: np.ndarray) -> np.ndarray:
+    return np.diff(totals, prepend=0.0)
+
+
+def rollingMean(values: np.ndarray, window: int = 7) -> np.ndarray:
+    sums = np.cumsum(values)
+    sums[window:] = sums[window:] - sums[:-window]
+    return sums / window
+
+
+def changesToArray(history: dict, field: str) -> np.ndarray:
+    """Like historyToArrays for one change_* field, with "na" mapped to NaN."""
+    return np.fromiter(
+        (
+            np.nan if record[field] == "na" else float(record[field])
+            for record in history.values()
+        ),
+        dtype=float,
+        count=len(history),
+    )
+
+
+class HistoryIndex:
+    """
+    One location's CovId19Data history as parallel date/total arrays.
+
+    lastValidIndex is the last day whose change in cases or deaths is known
+    and non-zero (regions that stopped reporting trail off with "na" or zero
+    days) and previousIndex is the day before it, or None if there is none.
+    """
+
+    def __init__(self, history: dict) -> None:
+        dates, columns = historyToArrays(history, ["confirmed", "deaths"])
+        self.dates = parseDates(dates)
+        self.confirmed = columns["confirmed"]
+        self.deaths = columns["deaths"]
+
+        changeConfirmed = changesToArray(history, "change_confirmed")
+        changeDeaths = changesToArray(history, "change_deaths")
+        valid = (
+            ~np.isnan(changeConfirmed)
+            & ~np.isnan(changeDeaths)
+            & ((changeConfirmed != 0) | (changeDeaths != 0))
+        )
+        validIndices = np.flatnonzero(valid)
+        self.lastValidIndex = None
+        self.previousIndex = None
+        if len(validIndices) > 0:
+            self.lastValidIndex = int(validIndices[-1])
+            if self.lastValidIndex > 0:
+                self.previousIndex = self.lastValidIndex - 1
+
+    def __len__(self) -> int:
+        return len(self.dates)
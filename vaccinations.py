@@ -8,15 +8,23 @@ And sends an automated response to a Telegram group via the Telegram Bot wheresm
 
 @author: Anirudh & Ajay
 """
-import urllib.request
-import json
-from matplotlib import pyplot as plt
+import concurrent.futures
+from matplotlib import dates as pltdates
 from matplotlib import ticker as pltticker
+import numpy as np
 import pandas as pd
 import prettytable as pt
+from response_cache import ResponseCache
+import report_parser
+from chart_output import (
+    newFigure,
+    figureToPng,
+    tightLayout,
+    FigureTemplate,
+    getFigureTemplate,
+)
+import timeseries
 
-stateVaccineImage = "state_vaccines.png"
-canadaVaccineImage = "canada_vaccines.png"
 urlProvince = "https://api.covid19tracker.ca/reports/province/"
 urlCanada = "https://api.covid19tracker.ca/reports"
 urlSuffix = {
@@ -49,6 +57,12 @@ urlSuffix = {
     "YT": "YT",
 }
 
+# The full name of each province (its longest name), for titles
+provinceNames = {
+    code: name
+    for name, code in sorted(urlSuffix.items(), key=lambda item: len(item[0]))
+}
+
 populationData = {
     "AB": 4428112,
     "BC": 5145851,
@@ -67,70 +81,110 @@ populationData = {
 
 canadaPopulation = sum(populationData.values())
 
+# covid19tracker.ca publishes at most a few times a day
+reportCacheTTL = 15 * 60
+# Reports are parsed as they download into arrays of just the plotted fields
+reportCache = ResponseCache(ttl=reportCacheTTL, parseStream=report_parser.ReportParser)
+# Only the last record, for summaries of reports that aren't cached whole
+latestRecordCache = ResponseCache(
+    ttl=reportCacheTTL, parse=report_parser.parseLatestRecord
+)
 
-def plotVaccinationsForURL(
+
+# Requests in flight at once for a batch, enough for every province together
+batchFetchWorkers = 16
+# Shared by every batch, so a command doesn't start and stop its own threads
+batchExecutor = concurrent.futures.ThreadPoolExecutor(
+    batchFetchWorkers, thread_name_prefix="covid19tracker"
+)
+# Columns of the small-multiples chart of every province
+provinceGridColumns = 4
+
+
+def loadReport(url: str) -> report_parser.ProjectedReport:
+    return reportCache.get(url)
+
+
+def loadLatestRecord(url: str) -> dict:
+    """The report's last record, taken from the full report if it is cached."""
+    report = reportCache.peek(url)
+    if report != None:
+        return report.latest
+    return latestRecordCache.get(url)
+
+
+def loadReports(urls: list) -> dict:
+    """Fetch the reports for urls concurrently and return them by URL."""
+    reports = {url: reportCache.peek(url) for url in urls}
+    # Only the ones that aren't cached and fresh need the executor
+    missing = [url for url, report in reports.items() if report == None]
+    if len(missing) > 0:
+        reports.update(zip(missing, batchExecutor.map(loadReport, missing)))
+    return reports
+
+
+def getProvinceCodes() -> list:
+    """Every province code once, in the order of the full province names."""
+    return sorted(provinceNames, key=lambda code: provinceNames[code])
+
+
+def loadAllReports() -> dict:
+    """Return Canada's and every province's report by code ("CA" for Canada)."""
+    codes = getProvinceCodes()
+    reports = loadReports([urlCanada] + [urlProvince + code for code in codes])
+    allReports = {code: reports[urlProvince + code] for code in codes}
+    allReports["CA"] = reports[urlCanada]
+    return allReports
+
+
+def getVaccinationChartSpec(
     url: str,
     title: str = "Vaccinations",
-    outputImage: str = "vaccinations.png",
     population: str = None,
-) -> None:
-    jsonData = json.loads(urllib.request.urlopen(url).read().decode())
-    dates = []
-    total_vaccinations = []
-    total_vaccinated = []
-    total_boosters_1 = []
-    new_vaccinations = []
-    new_vaccinated = []
-    new_boosters_1 = []
-    windowSize = 7
-    movingWindow = 7 * [0]
-    movingWindow2 = 7 * [0]
-    movingWindow3 = 7 * [0]
-    index = 0
-    last = 0
-
+) -> dict:
+    """Compute the plotted series as NumPy arrays for renderVaccinationChart."""
     if population == None:
         raise ValueError("Population data missing for plotting the vaccination data.")
-
-    for day_data in jsonData["data"]:
-        date = pd.to_datetime(day_data["date"])
-        if date > pd.Timestamp(2020, 12, 15):
-            dates.append(date)
-            if day_data["total_vaccinations"] == None:
-                total_vax = 0
-            else:
-                total_vax = day_data["total_vaccinations"] * 100.0 / population
-            if day_data["total_vaccinated"] == None:
-                total_full_vax = 0
-            else:
-                total_full_vax = day_data["total_vaccinated"] * 100.0 / population
-            if day_data["total_boosters_1"] == None:
-                total_boosters_1 = 0
-            else:
-                total_boosters_1 = day_data["total_boosters_1"] * 100.0 / population
-            total_vaccinated.append(total_full_vax)
-            total_vaccinations.append(total_vax - total_full_vax - total_boosters_1)
-            movingWindow[index] = day_data["change_vaccinations"]
-            if day_data["change_vaccinated"] != None:
-                movingWindow2[index] = day_data["change_vaccinated"]
-            else:
-                movingWindow2[index] = 0
-            if day_data["change_boosters_1"] == None:
-                movingWindow3[index] = 0
-            else:
-                movingWindow3[index] = day_data["change_boosters_1"]
-            new_vaccinations.append(sum(movingWindow) / len(movingWindow))
-            new_vaccinated.append(sum(movingWindow2) / len(movingWindow2))
-            new_boosters_1.append(sum(movingWindow3) / len(movingWindow3))
-            last = index
-            index = 0 if (index == (windowSize - 1)) else (index + 1)
-
-    fig, ax = plt.subplots()
-    ax.set_title(title)
+    return getReportChartSpec(loadReport(url), title, population)
+
+
+def getReportChartSpec(
+    report: report_parser.ProjectedReport, title: str, population: int
+) -> dict:
+    selected = np.flatnonzero(report.dates > np.datetime64("2020-12-15"))
+    # Missing values (null) count as 0
+    columns = {
+        field: np.nan_to_num(values[selected], nan=0.0)
+        for field, values in report.columns.items()
+    }
+    total_vax = columns["total_vaccinations"] * 100.0 / population
+    total_full_vax = columns["total_vaccinated"] * 100.0 / population
+    total_boosters_1 = columns["total_boosters_1"] * 100.0 / population
+
+    return {
+        "chart": "vaccinations",
+        "title": title,
+        "dates": pd.DatetimeIndex(report.dates[selected]),
+        "total_vaccinations": total_vax - total_full_vax - total_boosters_1,
+        "total_vaccinated": total_full_vax,
+        "new_vaccinations": timeseries.rollingMean(columns["change_vaccinations"]),
+        "new_vaccinated": timeseries.rollingMean(columns["change_vaccinated"]),
+    }
+
+
+def buildVaccinationTemplate(spec: dict) -> FigureTemplate:
+    dates = pd.to_datetime(spec["dates"])
+    total_vaccinations = spec["total_vaccinations"]
+    total_vaccinated = spec["total_vaccinated"]
+    new_vaccinations = spec["new_vaccinations"]
+    new_vaccinated = spec["new_vaccinated"]
+
+    fig = newFigure()
+    ax = fig.subplots()
     ln1 = ax.plot(dates, total_vaccinations, color="c", label="1-shot %")
     ln3 = ax.plot(dates, total_vaccinated, color="m", label="2-shot %")
     ax.set_ylabel("Total Vaccinations")
-    plt.xticks(rotation=45)
+    ax.tick_params(axis="x", labelrotation=45)
 
     # Second axis
     ax2 = ax.twinx()
@@ -153,29 +207,104 @@ def plotVaccinationsForURL(
     lns = ln1 + ln3 + ln4 + ln5
     labs = [l.get_label() for l in lns]
     ax.legend(lns, labs, loc=0)
-    fig.savefig(outputImage, format="png", dpi=300, bbox_inches="tight")
-    plt.close()
+    return FigureTemplate(
+        fig,
+        [ax, ax2],
+        {
+            "total_vaccinations": ln1[0],
+            "total_vaccinated": ln3[0],
+            "new_vaccinations": ln4[0],
+            "new_vaccinated": ln5[0],
+        },
+    )
 
 
-def plotCanadaVaccinations():
-    plotVaccinationsForURL(
-        urlCanada, "Vaccinations for Canada", canadaVaccineImage, canadaPopulation
+def renderVaccinationChart(spec: dict) -> bytes:
+    template = getFigureTemplate("vaccinations", lambda: buildVaccinationTemplate(spec))
+    fig = template.update(
+        spec["title"],
+        pd.to_datetime(spec["dates"]),
+        {name: spec[name] for name in template.lines},
     )
+    return figureToPng(fig)
+
+
+def plotVaccinationsForURL(
+    url: str,
+    title: str = "Vaccinations",
+    population: str = None,
+) -> bytes:
+    return renderVaccinationChart(getVaccinationChartSpec(url, title, population))
+
+
+def getCanadaChartSpec() -> dict:
+    return getVaccinationChartSpec(
+        urlCanada, "Vaccinations for Canada", canadaPopulation
+    )
+
+
+def getProvinceCode(province="Ontario") -> str:
+    """Accept a province name or code in any case; None if it isn't one."""
+    for candidate in (province, province.title(), province.upper()):
+        if candidate in urlSuffix:
+            return urlSuffix[candidate]
+    return None
 
 
-def plotVaccinations(province="Ontario") -> bool:
-    province = province.title()
-    if province not in urlSuffix:
+def getProvinceChartSpec(province="Ontario") -> dict:
+    code = getProvinceCode(province)
+    if code == None:
         print("FML")
-        return False
+        return None
     else:
-        plotVaccinationsForURL(
-            urlProvince + urlSuffix[province],
-            "Vaccinations for " + province,
-            stateVaccineImage,
-            populationData[urlSuffix[province]],
+        return getVaccinationChartSpec(
+            urlProvince + code,
+            "Vaccinations for " + provinceNames[code],
+            populationData[code],
         )
-        return True
+
+
+def plotCanadaVaccinations() -> bytes:
+    return renderVaccinationChart(getCanadaChartSpec())
+
+
+def plotVaccinations(province="Ontario") -> bytes:
+    spec = getProvinceChartSpec(province)
+    if spec == None:
+        return None
+    return renderVaccinationChart(spec)
+
+
+def getDataVersionForURL(url: str) -> tuple:
+    report = loadReport(url)
+    return (len(report), report.latest["date"])
+
+
+def getCanadaDataVersion() -> tuple:
+    return getDataVersionForURL(urlCanada)
+
+
+def getAllProvincesDataVersion(reports: dict = None) -> tuple:
+    """reports is the result of loadAllReports(), which is called if it is None."""
+    if reports == None:
+        reports = loadAllReports()
+    return tuple(
+        (code, len(report), report.latest["date"]) for code, report in reports.items()
+    )
+
+
+def getProvinceURL(province="Ontario") -> str:
+    code = getProvinceCode(province)
+    if code == None:
+        return None
+    return urlProvince + code
+
+
+def getProvinceDataVersion(province="Ontario") -> tuple:
+    url = getProvinceURL(province)
+    if url == None:
+        return None
+    return getDataVersionForURL(url)
 
 
 def tableAddSection(title, summary, table, population) -> None:
@@ -191,33 +320,31 @@ def tableAddSection(title, summary, table, population) -> None:
 
 def getSummaryData(url, title, population):
     summary = {}
-    jsonData = json.loads(urllib.request.urlopen(url).read().decode())
-    outputString = (
-        "<b>" + title + "</b>\n<i>(As of " + jsonData["data"][-1]["date"] + ")</i>\n"
-    )
+    latest = loadLatestRecord(url)
+    outputString = "<b>" + title + "</b>\n<i>(As of " + latest["date"] + ")</i>\n"
 
     table = pt.PrettyTable(["Vaccinated", "Count"])
     table.align["Vaccinated"] = "l"
     table.align["Count"] = "r"
 
     summary["- Today"] = (
-        jsonData["data"][-1]["change_vaccinations"]
-        - jsonData["data"][-1]["change_vaccinated"]
-        - jsonData["data"][-1]["change_boosters_1"]
+        latest["change_vaccinations"]
+        - latest["change_vaccinated"]
+        - latest["change_boosters_1"]
     )
     summary["- Total"] = (
-        jsonData["data"][-1]["total_vaccinations"]
-        - jsonData["data"][-1]["total_vaccinated"]
-        - jsonData["data"][-1]["total_boosters_1"]
+        latest["total_vaccinations"]
+        - latest["total_vaccinated"]
+        - latest["total_boosters_1"]
     )
     tableAddSection("1-shot", summary, table, population)
 
-    summary["- Today"] = jsonData["data"][-1]["change_vaccinated"]
-    summary["- Total"] = jsonData["data"][-1]["total_vaccinated"]
+    summary["- Today"] = latest["change_vaccinated"]
+    summary["- Total"] = latest["total_vaccinated"]
     tableAddSection("2-shot", summary, table, population)
 
-    summary["- Today"] = jsonData["data"][-1]["change_boosters_1"]
-    summary["- Total"] = jsonData["data"][-1]["total_boosters_1"]
+    summary["- Today"] = latest["change_boosters_1"]
+    summary["- Total"] = latest["total_boosters_1"]
     tableAddSection("Booster 1", summary, table, population)
 
     outputString += f"<pre>{table}</pre>"
@@ -226,31 +353,128 @@ def getSummaryData(url, title, population):
     return outputString
 
 
+def getVaccinationPercentages(record: dict, population: int) -> list:
+    """Return the 1-shot, 2-shot and booster percentages, as in getSummaryData."""
+    # Some provinces report null for the fields they don't track
+    total = record["total_vaccinations"] or 0
+    vaccinated = record["total_vaccinated"] or 0
+    boosters = record["total_boosters_1"] or 0
+    return [
+        min(100.0, 100.0 * count / population)
+        for count in (total - vaccinated - boosters, vaccinated, boosters)
+    ]
+
+
+def getAllProvincesSummary(reports: dict = None) -> str:
+    """A table comparing the latest numbers of every province and Canada."""
+    if reports == None:
+        reports = loadAllReports()
+    table = pt.PrettyTable(["", "1-shot", "2-shot", "Boost", "Today"])
+    table.align = "r"
+    table.align[""] = "l"
+    for code in getProvinceCodes() + ["CA"]:
+        record = reports[code].latest
+        population = canadaPopulation if code == "CA" else populationData[code]
+        percentages = getVaccinationPercentages(record, population)
+        table.add_row(
+            [code]
+            + ["{:.1f}%".format(percent) for percent in percentages]
+            + [format(record["change_vaccinations"] or 0, ",d")]
+        )
+
+    outputString = (
+        "<b>Vaccinations By Province</b>\n<i>(As of "
+        + reports["CA"].latest["date"]
+        + ")</i>\n"
+    )
+    outputString += f"<pre>{table}</pre>"
+    outputString += "\n"
+    return outputString
+
+
+def getAllProvincesChartSpec(reports: dict = None) -> dict:
+    if reports == None:
+        reports = loadAllReports()
+    provinces = []
+    for code in getProvinceCodes():
+        spec = getReportChartSpec(
+            reports[code],
+            "Vaccinations for " + provinceNames[code],
+            populationData[code],
+        )
+        provinces.append(
+            {
+                "title": provinceNames[code],
+                "dates": spec["dates"],
+                "total_vaccinations": spec["total_vaccinations"],
+                "total_vaccinated": spec["total_vaccinated"],
+            }
+        )
+    return {
+        "chart": "province_grid",
+        "title": "Vaccinations by Province",
+        "provinces": provinces,
+    }
+
+
+def renderProvinceGridChart(spec: dict) -> bytes:
+    """Plot each province's 1-shot and 2-shot % in its own small chart."""
+    provinces = spec["provinces"]
+    columns = provinceGridColumns
+    rows = -(-len(provinces) // columns)
+    fig = newFigure(figsize=(2.6 * columns, 2.0 * rows + 0.8))
+    axes = fig.subplots(rows, columns, sharex=True, sharey=True, squeeze=False)
+    axes = axes.flatten()
+    for ax, province in zip(axes, provinces):
+        dates = pd.to_datetime(province["dates"])
+        ax.plot(dates, province["total_vaccinations"], color="c", label="1-shot %")
+        ax.plot(dates, province["total_vaccinated"], color="m", label="2-shot %")
+        ax.set_title(province["title"], fontsize=9)
+        ax.set_ylim(0, 100)
+        ax.tick_params(labelsize=7)
+        ax.xaxis.set_major_locator(pltdates.YearLocator())
+        ax.xaxis.set_major_formatter(pltdates.DateFormatter("%Y"))
+    for index in range(len(provinces), len(axes)):
+        axes[index].set_visible(False)
+        # The chart above is now the bottom of its column, so it needs the dates
+        axes[index - columns].xaxis.set_tick_params(labelbottom=True)
+    handles, labels = axes[0].get_legend_handles_labels()
+    fig.legend(handles, labels, loc="lower right")
+    fig.suptitle(spec["title"])
+    fig.subplots_adjust(hspace=0.5, wspace=0.15)
+    tightLayout(fig)
+    return figureToPng(fig)
+
+
 def getCanadaSummary() -> str:
     return getSummaryData(urlCanada, "Canada Vaccinations", canadaPopulation).title()
 
 
 def getSummary(province="Ontario"):
-    province = province.title()
+    code = getProvinceCode(province)
     provinceString = ""
-    if province in urlSuffix:
+    if code != None:
         provinceString = getSummaryData(
-            urlProvince + urlSuffix[province],
-            province.title() + " Vaccinations",
-            populationData[urlSuffix[province]],
+            urlProvince + code,
+            provinceNames[code] + " Vaccinations",
+            populationData[code],
         )
     return provinceString.title()
 
 
 def main() -> None:
-    for (key, item) in urlSuffix.items():
+    reports = loadAllReports()
+    for code in getProvinceCodes():
         print(
             getSummaryData(
-                urlProvince + item, key + " Vaccinations", populationData[item]
+                urlProvince + code,
+                provinceNames[code] + " Vaccinations",
+                populationData[code],
             )
         )
 
     print(getCanadaSummary())
+    print(getAllProvincesSummary(reports))
     plotCanadaVaccinations()
     plotVaccinations("Ontario")
 